@@ -0,0 +1,135 @@
+import os
+import random
+
+import h5py
+import numpy as np
+from PIL import Image
+
+
+WORDS = ('yamaha classical nylon string guitar guitars acoustic electric bass fender gibson black red blue '
+         'sunburst maple rosewood solid body dreadnought cutaway steel full size c40 cg192s strat tele les paul '
+         'ukulele mandolin banjo pick strap tuner capo case gig bag amp pedal cable stand').split()
+CATEGORIES = ['MusicalInstruments>Guitars>ElectricGuitars', 'MusicalInstruments>Guitars>AcousticGuitars',
+              'MusicalInstruments>Guitars>ClassicalGuitars', 'MusicalInstruments>Bass>Electric',
+              'MusicalInstruments>Ukuleles', 'MusicalInstruments>Accessories>Picks',
+              'MusicalInstruments>Accessories>Straps', 'MusicalInstruments>Amplifiers>Guitar',
+              'MusicalInstruments>Drums>Cymbals', 'MusicalInstruments>Keyboards>Synthesizers']
+
+
+def make_config(root, docvec_size=100, vocab_size=300):
+    # same keys as configs/config-*.yaml, every path under root
+    return {
+        'PARSEMETA': {
+            'META_PATH': os.path.join(root, 'metadata.json.gz'),
+            'TITLES_PATH': os.path.join(root, 'spm/titles.txt'),
+            'SPM_DIR_PATH': os.path.join(root, 'spm'),
+            'SPM_WP_PATH': os.path.join(root, 'spm/spm.vocab'),
+            'CATEGORY_PATH': os.path.join(root, 'products/category.txt'),
+            'PARSE_DATA_PATH': os.path.join(root, 'products/products.tsv'),
+            'DOC2VEC_DIR_PATH': os.path.join(root, 'doc2vec'),
+            'USE_COLS': ['asin', 'imUrl', 'title', 'categories'],
+            'USE_CATE': [],
+            'CATE_DEPTH': 4,
+            'N_SHUFFLE': 3,
+            'VOCAB_SIZE': vocab_size,
+            'N_SAMPLE': 10000000,
+            'N_LOG_PRINT': 10000000,
+            'DOC_VEC_SIZE': docvec_size,
+            'DOC2CEC_EPOCHS': 5,
+            'N_WORKERS': 1,
+            'WINDOW_SIZE': 3,
+            'INFER_SEED': 0,
+            'TEXT2VEC_CACHE_SIZE': 0,
+            'TEXT2VEC_CACHE_PATH': ''},
+        'MAKEDB': {
+            'TRAIN_DIR_PATH': os.path.join(root, 'products/train'),
+            'CHUNK_SIZE': 1000,
+            'IMAGE_DIR_PATH': os.path.join(root, 'products/images'),
+            'IMAGE_SIZE': 128,
+            'SHARD_SIZE': 1024,
+            'N_WORKERS': 1,
+            'N_VEC_WORKERS': 1}}
+
+
+def random_title(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 16)))
+
+
+def make_products(config, n_products, seed=0):
+    # products.tsv (N_SHUFFLE lines per product, like parse_data), titles.txt and category.txt
+    parse_config = config['PARSEMETA']
+    rng = random.Random(seed)
+    for path in [parse_config['PARSE_DATA_PATH'], parse_config['TITLES_PATH']]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(parse_config['CATEGORY_PATH'], 'w') as f:
+        f.write('\n'.join(CATEGORIES) + '\n')
+    titles = []
+    with open(parse_config['PARSE_DATA_PATH'], 'w') as f:
+        for i in range(n_products):
+            words = random_title(rng).split()
+            category = rng.choice(CATEGORIES)
+            for _ in range(parse_config['N_SHUFFLE']):
+                rng.shuffle(words)
+                titles.append(' '.join(words))
+                f.write('B%09d\t%s\t%s\thttp://example.invalid/%d.jpg\n' % (i, category, titles[-1], i))
+    with open(parse_config['TITLES_PATH'], 'w') as f:
+        f.write('\n'.join(titles) + '\n')
+    return titles
+
+
+def make_images(config, n_products, size=300, seed=0):
+    # smooth random images (jpeg decodes them at the speed of photos, unlike white noise)
+    image_dir = config['MAKEDB']['IMAGE_DIR_PATH']
+    os.makedirs(image_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    for i in range(n_products):
+        small = rng.randint(0, 256, (8, 8, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((size, size), Image.BICUBIC)
+        image.save(os.path.join(image_dir, 'B%09d.jpg' % i), quality=90)
+
+
+def make_db(config, n_products, train_ratio=0.8, seed=0):
+    # data.h5py in the layout written by make_db.py, with random docvecs
+    parse_config = config['PARSEMETA']
+    rng = np.random.RandomState(seed)
+    n_rows = n_products * parse_config['N_SHUFFLE']
+    asins = np.array(['B%09d.jpg' % (i // parse_config['N_SHUFFLE']) for i in range(n_rows)], dtype='S14')
+    is_train = rng.rand(n_rows) < train_ratio
+    os.makedirs(config['MAKEDB']['TRAIN_DIR_PATH'], exist_ok=True)
+    with h5py.File(os.path.join(config['MAKEDB']['TRAIN_DIR_PATH'], 'data.h5py'), 'w') as data:
+        for split, mask in [('train', is_train), ('dev', ~is_train)]:
+            g = data.create_group(split)
+            n = int(mask.sum())
+            g.create_dataset('asin', data=asins[mask], maxshape=(None,), chunks=True)
+            g.create_dataset('cate', data=rng.randint(0, len(CATEGORIES), n).astype(np.int32), maxshape=(None,),
+                             chunks=True)
+            g.create_dataset('docvec', data=rng.randn(n, parse_config['DOC_VEC_SIZE']).astype(np.float32),
+                             maxshape=(None, parse_config['DOC_VEC_SIZE']), chunks=True)
+            g.attrs['num_classes'] = len(CATEGORIES)
+
+
+def make_text_models(config):
+    # spm + spm.vocab + doc2vec trained on the fixture titles (needs sentencepiece and gensim)
+    import sentencepiece as spm
+    from parse_metadata import EcommerceDataParser
+    parser = EcommerceDataParser(config['PARSEMETA'])
+    os.makedirs(parser.spm_dir_path, exist_ok=True)
+    spm.SentencePieceTrainer.Train(input=parser.titles_path, model_type='bpe', vocab_size=parser.vocab_size,
+                                   model_prefix=os.path.join(parser.spm_dir_path, 'spm'))
+    parser.build_x_vocab(parser.titles_path, parser.spm_dir_path, parser.spm_wp_path)
+    parser.load_spm()
+    parser.train_doc2vec()
+
+
+def make_fixture(root, n_products=512, image_size=300, docvec_size=100, text=True, seed=0):
+    '''
+    Synthetic catalogue under root: products.tsv, category.txt, <asin>.jpg images, data.h5py and, with
+    text=True, the spm/doc2vec models. -> config dict as read from configs/config-<servertype>.yaml
+    '''
+    config = make_config(root, docvec_size)
+    make_products(config, n_products, seed)
+    make_images(config, n_products, image_size, seed)
+    make_db(config, n_products, seed=seed)
+    if text:
+        make_text_models(config)
+    return config
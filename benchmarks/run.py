@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import statistics
+
+import fire
+import numpy as np
+import torch
+
+from benchmarks.fixtures import make_fixture
+
+
+GROUPS = ['data', 'text', 'db', 'model', 'train']
+
+
+def measure(fn, n_items=1, min_time=1.0, max_repeat=50, n_warmup=1):
+    # items/sec from the median time of repeated calls, at least min_time of calls after the warmup
+    for _ in range(n_warmup):
+        fn()
+    times = []
+    while len(times) < max_repeat and (sum(times) < min_time or len(times) < 3):
+        st = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - st)
+    return n_items / statistics.median(times)
+
+
+def result(name, value, unit, higher_is_better=True):
+    return name, {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def bench_data(config, root, quick):
+    from torch.utils.data import DataLoader
+    from data_loader import ImTextDataset
+    results = []
+    for meta_mode in ['memory', 'h5']:
+        dataset = ImTextDataset(root, image_size=128, meta_mode=meta_mode)
+        indices = np.random.RandomState(0).randint(0, len(dataset), 64)
+        results.append(result('data.getitem[meta=%s]' % meta_mode,
+                              measure(lambda: [dataset[i] for i in indices], len(indices)), 'samples/s'))
+    dataset = ImTextDataset(root, image_size=128)
+    for num_workers in ([0] if quick else [0, 2]):
+        loader = DataLoader(dataset, batch_size=64, shuffle=True, num_workers=num_workers, drop_last=True)
+
+        def epoch():
+            for _ in loader:
+                pass
+        n_samples = len(loader) * loader.batch_size
+        results.append(result('data.loader[workers=%d]' % num_workers,
+                              measure(epoch, n_samples, max_repeat=3), 'samples/s'))
+    return results
+
+
+def bench_text(config, root, quick):
+    from parse_metadata import EcommerceDataParser
+    parser = EcommerceDataParser(config['PARSEMETA'], use=True)
+    with open(config['PARSEMETA']['TITLES_PATH']) as f:
+        titles = [line.strip() for line in f][1:]
+    titles = random.Random(0).sample(titles, min(len(titles), 1000))
+    vec_titles = titles[:50 if quick else 200]
+    return [
+        result('text.text2wp', measure(lambda: [parser.text2wp(t) for t in titles], len(titles)), 'titles/s'),
+        result('text.text2wp_batch', measure(lambda: parser.text2wp_batch(titles), len(titles)), 'titles/s'),
+        result('text.text2vec', measure(lambda: [parser.text2vec(t) for t in vec_titles], len(vec_titles),
+                                        max_repeat=3), 'titles/s'),
+    ]
+
+
+def bench_db(config, root, quick):
+    from make_db import eCommerceData
+    # build into its own directory, the data benchmarks read the fixture db
+    db_config = dict(config, MAKEDB=dict(config['MAKEDB'], TRAIN_DIR_PATH=os.path.join(root, 'bench_db')))
+    with open(config['PARSEMETA']['PARSE_DATA_PATH']) as f:
+        n_rows = sum(1 for _ in f)
+
+    def build():
+        eCommerceData(db_config).save_caption_vectors_products(train_ratio=0.8, seed=0, resume=False)
+    return [result('db.save_caption_vectors_products', measure(build, n_rows, n_warmup=0, max_repeat=1 if quick else 3),
+                   'rows/s')]
+
+
+def bench_model(config, root, quick):
+    from model import NetD, NetG
+    # train.py defaults
+    n_cls, docvec_size = 10, config['PARSEMETA']['DOC_VEC_SIZE']
+    netD = NetD(n_cls=n_cls, n_t=100, n_f=64, docvec_size=docvec_size)
+    netG = NetG(n_z=100, n_l=100, n_t=docvec_size, n_c=64)
+    results = []
+    for batch_size in ([1, 16] if quick else [1, 16, 64]):
+        image = torch.rand(batch_size, 3, 128, 128)
+        docvec = torch.randn(batch_size, docvec_size)
+        noise = torch.randn(batch_size, 100)
+        if batch_size == 1:
+            # BatchNorm in training mode needs more than one value per channel
+            netD.eval()
+            netG.eval()
+        else:
+            netD.train()
+            netG.train()
+
+        def netD_forward():
+            with torch.no_grad():
+                netD(image, docvec)
+
+        def netD_backward():
+            netD.zero_grad()
+            s, c = netD(image, docvec, logits=True)
+            (s.sum() + c.sum()).backward()
+
+        def netG_forward():
+            with torch.no_grad():
+                netG(noise, docvec)
+
+        def netG_backward():
+            netG.zero_grad()
+            netG(noise, docvec).sum().backward()
+
+        for name, fn in [('netD.forward', netD_forward), ('netD.forward_backward', netD_backward),
+                         ('netG.forward', netG_forward), ('netG.forward_backward', netG_backward)]:
+            results.append(result('model.%s[batch=%d]' % (name, batch_size), measure(fn, batch_size), 'samples/s'))
+    return results
+
+
+def bench_train(config, root, quick):
+    import itertools
+    import h5py
+    import torch.nn.functional as F
+    from torch.utils.data import DataLoader
+    from data_loader import ImTextDataset, DevicePrefetcher
+    from model import NetD, NetG
+    # a NetD + NetG update per batch, batches moved by DevicePrefetcher with the step tensors built on the
+    # device (prefetch=on) or copied tensor by tensor with the step tensors built on the host (prefetch=off,
+    # the loop before DevicePrefetcher). On cpu both paths do the same work
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    n_z, docvec_size = 100, config['PARSEMETA']['DOC_VEC_SIZE']
+    dataset = ImTextDataset(root, image_size=128)
+    with h5py.File(dataset.data_path, 'r') as data:
+        n_cls = int(data['train'].attrs['num_classes'])
+    netD = NetD(n_cls=n_cls, n_t=100, n_f=64, docvec_size=docvec_size).to(device).train()
+    netG = NetG(n_z=n_z, n_l=100, n_t=docvec_size, n_c=64).to(device).train()
+    optimizerD = torch.optim.Adam(netD.parameters(), lr=0.0002, betas=(0.5, 0.999))
+    optimizerG = torch.optim.Adam(netG.parameters(), lr=0.0002, betas=(0.5, 0.999))
+
+    bce = F.binary_cross_entropy_with_logits
+
+    def step(images, labels, captions, noise, lbl_real, lbl_fake, perm):
+        netD.zero_grad()
+        fake = netG(noise, captions)
+        d_real, c_real = netD(images, captions, logits=True)
+        d_fake, c_fake = netD(fake.detach(), captions[perm], logits=True)
+        (bce(d_real, lbl_real) + bce(c_real, labels) + bce(d_fake, lbl_fake) + bce(c_fake, labels[perm])).backward()
+        optimizerD.step()
+        netG.zero_grad()
+        d_fake, c_fake = netD(fake, captions, logits=True)
+        (bce(d_fake, lbl_real) + bce(c_fake, labels)).backward()
+        optimizerG.step()
+
+    def prefetch_on(loader, n_steps):
+        for images, cates, captions in itertools.islice(DevicePrefetcher(loader, device), n_steps):
+            n = images.size(0)
+            step(images, F.one_hot(cates.long(), n_cls).float(), captions, torch.randn(n, n_z, device=device),
+                 torch.ones(n, 1, device=device), torch.zeros(n, 1, device=device), torch.randperm(n, device=device))
+
+    def prefetch_off(loader, n_steps):
+        for images, cates, captions in itertools.islice(loader, n_steps):
+            n = images.size(0)
+            host = [images, F.one_hot(cates.long(), n_cls).float(), captions, torch.randn(n, n_z), torch.ones(n, 1),
+                    torch.zeros(n, 1), torch.randperm(n)]
+            step(*[t.to(device) for t in host])
+
+    results = []
+    n_steps = 4 if quick else 8
+    for batch_size in ([16] if quick else [16, 64]):
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0 if quick else 2,
+                            pin_memory=device.type == 'cuda', drop_last=True)
+        for name, fn in [('on', prefetch_on), ('off', prefetch_off)]:
+            def steps():
+                fn(loader, n_steps)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+            results.append(result('train.step[device=%s,prefetch=%s,batch=%d]' % (device.type, name, batch_size),
+                                  measure(steps, n_steps * batch_size, max_repeat=3), 'samples/s'))
+    return results
+
+
+BENCHMARKS = {'data': bench_data, 'text': bench_text, 'db': bench_db, 'model': bench_model, 'train': bench_train}
+
+
+def machine():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(), 'python': platform.python_version(),
+            'torch': torch.__version__, 'numpy': np.__version__}
+
+
+def compare_results(results, baseline, threshold=0.2):
+    # prints the relative change of every benchmark (negative: slower), returns the ones slower than threshold
+    if results['machine'] != baseline['machine']:
+        print('note: the baseline was measured on another machine or software version')
+    regressions = []
+    print('%-50s %14s %14s %8s' % ('benchmark', 'baseline', 'current', 'change'))
+    for name, entry in sorted(results['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            print('%-50s %14s %14.2f %8s' % (name, '-', entry['value'], 'new'))
+            continue
+        change = entry['value'] / base['value'] - 1
+        if not entry['higher_is_better']:
+            change = base['value'] / entry['value'] - 1
+        flag = ''
+        if change < -threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('%-50s %14.2f %14.2f %+7.1f%%%s' % (name, base['value'], entry['value'], change * 100, flag))
+    return regressions
+
+
+def check_regressions(regressions):
+    if regressions:
+        raise SystemExit('%d benchmarks regressed: %s' % (len(regressions), ', '.join(regressions)))
+
+
+def compare(results, baseline='benchmarks/baseline.json', threshold=0.2):
+    """
+    Compares two result files, exits with an error if a benchmark is more than threshold slower.
+    python -m benchmarks.run compare bench_results.json [benchmarks/baseline.json] [--threshold 0.2]
+    """
+    with open(results) as f:
+        results = json.load(f)
+    with open(baseline) as f:
+        baseline = json.load(f)
+    check_regressions(compare_results(results, baseline, threshold))
+
+
+def run(only=None, out='bench_results.json', baseline='benchmarks/baseline.json', threshold=0.2, fixture_dir=None,
+        n_products=512, quick=False, threads=None, fail_on_regression=False):
+    """
+    Runs the benchmarks on cpu over a synthetic catalogue and writes the results to JSON.
+    python -m benchmarks.run run [--only data,text,db,model,train] [--out bench_results.json] [--quick]
+    Groups whose dependencies are missing (e.g. sentencepiece/gensim for text and db) are skipped and listed.
+    The results are compared against --baseline if it exists; to update it, run with --out benchmarks/baseline.json
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    groups = GROUPS if only is None else ([only] if isinstance(only, str) else list(only))
+    for group in groups:
+        if group not in GROUPS:
+            raise ValueError('benchmark groups are {}: {}'.format(GROUPS, group))
+
+    root = fixture_dir or tempfile.mkdtemp(prefix='tacgan_bench_')
+    try:
+        st = time.time()
+        text = 'text' in groups or 'db' in groups
+        try:
+            config = make_fixture(root, n_products=n_products, text=text)
+        except ImportError as e:
+            print('no text models for the fixture: %s' % e)
+            config = make_fixture(root, n_products=n_products, text=False)
+            text = False
+        print('fixture: %d products in %s (%.1f sec)' % (n_products, root, time.time() - st))
+
+        output = {'machine': machine(), 'settings': {'n_products': n_products, 'quick': quick},
+                  'results': {}, 'skipped': {}}
+        for group in groups:
+            if group in ('text', 'db') and not text:
+                output['skipped'][group] = 'the text fixture needs sentencepiece and gensim'
+                continue
+            st = time.time()
+            try:
+                for name, entry in BENCHMARKS[group](config, root, quick):
+                    output['results'][name] = entry
+                    print('%-50s %12.2f %s' % (name, entry['value'], entry['unit']))
+            except ImportError as e:
+                output['skipped'][group] = str(e)
+                print('%s skipped: %s' % (group, e))
+                continue
+            print('%s done (%.1f sec)' % (group, time.time() - st))
+    finally:
+        if fixture_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('results -> %s' % out)
+
+    if baseline and os.path.exists(baseline) and os.path.abspath(baseline) != os.path.abspath(out):
+        with open(baseline) as f:
+            regressions = compare_results(output, json.load(f), threshold)
+        if fail_on_regression:
+            check_regressions(regressions)
+
+
+if __name__ == '__main__':
+    fire.Fire({'run': run, 'compare': compare})
@@ -0,0 +1,122 @@
+import os
+import re
+import queue
+import threading
+import torch
+
+
+def to_cpu(obj):
+    # copy of a (nested) state dict with every tensor copied to host memory, safe to write while training goes on
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    # write to a temp file next to path and rename it: path is either the old or the complete new file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def checkpoint_path(ckpt_dir, prefix, epoch):
+    return os.path.join(ckpt_dir, '%sepoch_%d.pth' % (prefix, epoch))
+
+
+def checkpoint_epochs(ckpt_dir, prefix=''):
+    # epochs of the committed checkpoints, newest first (temp files of interrupted writes are ignored)
+    if not os.path.isdir(ckpt_dir):
+        return []
+    pattern = re.compile(r'^%sepoch_(\d+)\.pth$' % re.escape(prefix))
+    epochs = []
+    for name in os.listdir(ckpt_dir):
+        m = pattern.match(name)
+        if m:
+            epochs.append(int(m.group(1)))
+    return sorted(epochs, reverse=True)
+
+
+def load_latest_checkpoint(ckpt_dir, prefix='', map_location='cpu'):
+    # newest checkpoint that loads, skipping unreadable ones. None if there is none
+    for epoch in checkpoint_epochs(ckpt_dir, prefix):
+        path = checkpoint_path(ckpt_dir, prefix, epoch)
+        try:
+            return torch.load(path, map_location=map_location, weights_only=False)
+        except Exception as e:
+            print('checkpoint %s is not readable, trying an older one (%s)' % (path, e))
+    return None
+
+
+class AsyncCheckpointer():
+    '''
+    ckpt_dir : directory of the full training state checkpoints
+    prefix   : file name prefix, files are <prefix>epoch_<epoch>.pth
+    keep     : number of the most recent full checkpoints kept (0: keep all)
+
+    save() takes a snapshot already copied to cpu (see to_cpu) and returns right away; the files are written
+    by one background thread. At most one snapshot waits behind the one being written, so a slow disk blocks
+    training instead of piling up copies of the state in memory.
+    '''
+    def __init__(self, ckpt_dir, prefix='', keep=3):
+        self.ckpt_dir = ckpt_dir
+        self.prefix = prefix
+        self.keep = keep
+        self.error = None
+        os.makedirs(ckpt_dir, exist_ok=True)
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def path(self, epoch):
+        return checkpoint_path(self.ckpt_dir, self.prefix, epoch)
+
+    def save(self, epoch, state, extra_files=()):
+        '''
+        state       : full training state (cpu copy), written to path(epoch)
+        extra_files : (obj, path) pairs written atomically as well, e.g. the per-epoch model state dicts
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((epoch, state, list(extra_files)))
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            epoch, state, extra_files = item
+            try:
+                for obj, path in extra_files:
+                    atomic_save(obj, path)
+                # the full state goes last: when it exists, the files of its epoch are complete
+                atomic_save(state, self.path(epoch))
+                self.prune()
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def prune(self):
+        if self.keep <= 0:
+            return
+        for epoch in checkpoint_epochs(self.ckpt_dir, self.prefix)[self.keep:]:
+            os.remove(self.path(epoch))
+
+    def wait(self):
+        # block until every queued checkpoint is on disk
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -7,6 +7,12 @@ import torchvision.transforms as transforms
 from PIL import Image
 import numpy.random as random
 import h5py
+from misc import load_valid_mask, get_build_id
+
+
+META_KEYS = ['asin', 'cate', 'docvec']
+META_MODES = ['memory', 'mmap', 'h5']
+IMAGE_MODES = ['jpeg', 'shard']
 
 
 class ImTextDataset(Dataset):
@@ -15,32 +21,149 @@ class ImTextDataset(Dataset):
     dataset    : name of the dataset (eg. flowers/coco)
     train      : determines which part of the dataset to use. By default:train
     image_size : intented image size. By default: 128x128
+    meta_mode  : how asin/cate/docvec are kept. By default: memory
+                 memory - read once into numpy arrays (shared with workers after fork)
+                 mmap   - exported once to .npy files next to data.h5py and memory-mapped
+                 h5     - read per sample from an h5py handle opened once per worker
+    image_mode : where images come from. By default: jpeg
+                 jpeg  - decode and resize images/<asin> with PIL on every sample
+                 shard - pre-decoded uint8 shards built by `make_db.py make_shards`,
+                         returned as uint8 3 x image_size x image_size tensors without a copy.
+                         shards built from another data.h5py raise ValueError
+    shard_dir  : directory of the image shards. By default: train/shards_<image_size>
+    image_dir  : directory of the <asin>.jpg images, e.g. the training-size copies written by
+                 `image_downloader.py --thumb-size`. By default: <data_dir>/<dataset>/images
+    valid_path : bitmap of rows with a decodable image, built by `make_db.py check_images`.
+                 By default: train/valid_<split>.npz if it exists. Indices are mapped onto
+                 the valid rows only, so samplers never draw a missing image. A mask built
+                 for another data.h5py (row count or build id) raises ValueError.
     '''
-    def __init__(self, data_dir, dataset='products', train=True, image_size=128, cap_size_per_img=1, cate=None):
+    def __init__(self, data_dir, dataset='products', train=True, image_size=128, cap_size_per_img=1, cate=None,
+                 meta_mode='memory', image_mode='jpeg', shard_dir=None, valid_path=None, image_dir=None):
         super(ImTextDataset, self).__init__()
-        
+
+        if meta_mode not in META_MODES:
+            raise ValueError('meta_mode should be one of {}: {}'.format(META_MODES, meta_mode))
+        if image_mode not in IMAGE_MODES:
+            raise ValueError('image_mode should be one of {}: {}'.format(IMAGE_MODES, image_mode))
+
         self.train = train  # determines whether to return train or validation images
+        self.split = 'train' if train else 'dev'
         self.data_dir = data_dir
         self.dataset = dataset
-        self.image_dir = os.path.join(self.data_dir, dataset, 'images')
+        self.image_dir = image_dir or os.path.join(self.data_dir, dataset, 'images')
         self.data_path = os.path.join(data_dir, dataset, 'train/data.h5py')
-        #self.data = h5py.File(os.path.join(data_dir, dataset, 'train/data.h5py'), 'r')['train']
         self.trans_img = transforms.Compose([transforms.Resize((image_size, image_size)), #transforms.CenterCrop(image_size),
                                              transforms.ToTensor(),])# transformation for output image
         self.cap_size_per_img = cap_size_per_img
+        self.meta_mode = meta_mode
+        self.image_size = image_size
+        self.image_mode = image_mode
+        self.shard_dir = shard_dir or os.path.join(os.path.dirname(self.data_path), 'shards_{}'.format(image_size))
+
+        # h5py handles must not be shared across fork, so the handle is opened lazily per process
+        self._h5 = None
+        self._h5_pid = None
+
+        with h5py.File(self.data_path, 'r') as data:
+            self.n_data = data[self.split]['asin'].shape[0]
+            self.build_id = get_build_id(data)
+            if self.meta_mode == 'memory':
+                self.meta = {k: data[self.split][k][:] for k in META_KEYS}
+
+        if self.meta_mode == 'mmap':
+            self.meta = self.load_mmap_meta()
+
+        valid = None
+        valid_path = valid_path or os.path.join(os.path.dirname(self.data_path), 'valid_{}.npz'.format(self.split))
+        if os.path.exists(valid_path):
+            # a mask of a previous build would index the wrong rows
+            valid = load_valid_mask(valid_path, self.n_data, self.build_id)
+
+        if self.image_mode == 'shard':
+            self.shards = {}
+            shard_valid = load_valid_mask(os.path.join(self.shard_dir, '{}_valid.npz'.format(self.split)),
+                                          self.n_data, self.build_id)
+            valid = shard_valid if valid is None else valid & shard_valid
+            first = self.get_shard(0)
+            self.shard_size = first.shape[0]
+            if first.shape[1:] != (3, image_size, image_size):
+                raise ValueError('shards in {} have shape {}, expected image size {}'.format(
+                    self.shard_dir, first.shape[1:], image_size))
+
+        # dataset index -> db row, None when every row is assumed valid
+        self.rows = np.flatnonzero(valid) if valid is not None else None
+
+    def meta_cache_path(self, key):
+        return os.path.join(os.path.dirname(self.data_path), '{}_{}.npy'.format(self.split, key))
+
+    def load_mmap_meta(self):
+        # export each column once (chunk by chunk) and reuse it until data.h5py changes
+        db_mtime = os.path.getmtime(self.data_path)
+        stale = [k for k in META_KEYS
+                 if not os.path.exists(self.meta_cache_path(k)) or os.path.getmtime(self.meta_cache_path(k)) < db_mtime]
+        if stale:
+            with h5py.File(self.data_path, 'r') as data:
+                for k in stale:
+                    ds = data[self.split][k]
+                    # one temp file per process, ranks and dataset instances may export the same column at once
+                    tmp_path = self.meta_cache_path(k) + '.{}.tmp.npy'.format(os.getpid())
+                    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.dtype(ds.dtype.str), shape=ds.shape)
+                    step = ds.chunks[0] * 64 if ds.chunks else 65536
+                    for start in range(0, ds.shape[0], step):
+                        out[start:start + step] = ds[start:start + step]
+                    out.flush()
+                    del out
+                    os.replace(tmp_path, self.meta_cache_path(k))
+        # copy-on-write mapping so rows can be handed to torch without a read-only warning
+        return {k: np.load(self.meta_cache_path(k), mmap_mode='c') for k in META_KEYS}
+
+    def get_h5(self):
+        pid = os.getpid()
+        if self._h5 is None or self._h5_pid != pid:
+            self._h5 = h5py.File(self.data_path, 'r')
+            self._h5_pid = pid
+        return self._h5[self.split]
+
+    def get_shard(self, index):
+        # np.load with mmap only maps the file, pages are read on access
+        if index not in self.shards:
+            path = os.path.join(self.shard_dir, '{}_{:05d}.npy'.format(self.split, index))
+            self.shards[index] = np.load(path, mmap_mode='c')
+        return self.shards[index]
+
+    def get_shard_image(self, index):
+        return torch.from_numpy(self.get_shard(index // self.shard_size)[index % self.shard_size])
+
+    def get_meta(self, index):
+        meta = self.get_h5() if self.meta_mode == 'h5' else self.meta
+        asin = meta['asin'][index].decode("utf-8")
+        vec = np.asarray(meta['docvec'][index])
+        cate = np.asarray(meta['cate'][index])
+        if cate.ndim == 1:
+            # dbs built before cate was stored as a class index hold a one-hot row
+            cate = cate.argmax()
+        cate = np.int64(cate)
+        return asin, cate, vec
 
     def __getitem__(self, index):
+        if self.rows is not None:
+            index = self.rows[index]
+            asin, cate, vec = self.get_meta(index)
+            if self.image_mode == 'shard':
+                image = self.get_shard_image(index)
+            else:
+                image = self.trans_img(Image.open(os.path.join(self.image_dir, asin)))
+            return image, cate, vec
+
+        # no valid index: fall back to retrying random rows
         getflag = False
         image = None
         vec = None
         cate = None
         n_retry = 0
         while not getflag:
-            with h5py.File(self.data_path, 'r') as data:
-                train = data['train']
-                asin = train['asin'][index].decode("utf-8")
-                vec = train['docvec'][index]
-                cate = train['cate'][index]
+            asin, cate, vec = self.get_meta(index)
 
             # load the image and apply the transformation to it
             image_path = os.path.join(self.image_dir, asin)
@@ -61,12 +184,57 @@ class ImTextDataset(Dataset):
         return image, cate, vec
 
     def __len__(self):
-        # return len(self.db[self.labels_key])
-        with h5py.File(self.data_path, 'r') as data:
-            db = data['train']
-            lens = db['asin'].shape[0]
-        return lens
+        if self.rows is not None:
+            return len(self.rows)
+        return self.n_data
+
+    def __getstate__(self):
+        # never pickle an open h5py handle into worker processes (spawn start method)
+        state = self.__dict__.copy()
+        state['_h5'] = None
+        state['_h5_pid'] = None
+        return state
 
-    # def __len__(self):
-    #     if self.train:
-    #         return self.data['asin'].shape[0]
+
+class DevicePrefetcher(object):
+    '''
+    loader : DataLoader whose batches are tuples of tensors (use pin_memory=True for cuda)
+    device : device the batches are moved to
+
+    Iterates over the loader one batch ahead: the host-to-device copy of the next batch is issued on a
+    separate cuda stream (non_blocking, from pinned memory) while the current batch is being computed.
+    On cpu the batches are returned as they are.
+    '''
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        if self.stream is None:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return tuple(t.to(self.device, non_blocking=True) for t in batch)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        try:
+            next_batch = self.to_device(next(it))
+        except StopIteration:
+            return
+        while next_batch is not None:
+            if self.stream is not None:
+                current = torch.cuda.current_stream(self.device)
+                current.wait_stream(self.stream)
+                for t in next_batch:
+                    # the memory was allocated on the side stream but is used on the current one
+                    t.record_stream(current)
+            batch = next_batch
+            try:
+                next_batch = self.to_device(next(it))
+            except StopIteration:
+                next_batch = None
+            yield batch
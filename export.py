@@ -0,0 +1,308 @@
+import os
+import copy
+import json
+import time
+
+import fire
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_weights
+
+from misc import get_logger
+
+
+MODELS = ['netG', 'netD']
+
+
+def fold_conv_bn(conv, bn, transpose=False):
+    # conv followed by BatchNorm in eval mode -> one conv with the normalization in its weights
+    fused = copy.deepcopy(conv)
+    fused.weight, fused.bias = fuse_conv_bn_weights(conv.weight, conv.bias, bn.running_mean, bn.running_var,
+                                                    bn.eps, bn.weight, bn.bias, transpose=transpose)
+    return fused
+
+
+def fold_linear_bn2d(linear, bn, spatial):
+    # linear whose output is viewed as channels x spatial (channel-major) and followed by BatchNorm2d
+    fused = copy.deepcopy(linear)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    scale = scale.repeat_interleave(spatial)
+    shift = shift.repeat_interleave(spatial)
+    fused.weight = nn.Parameter((linear.weight * scale[:, None]).detach())
+    fused.bias = nn.Parameter((linear.bias * scale + shift).detach())
+    return fused
+
+
+class FoldedNetG(nn.Module):
+    '''
+    NetG for inference: emb_bn folded into lin_zc, convtr1-3_bn into their transposed convs.
+    Same output as NetG in eval mode: N x 3 x 128 x 128 images in [0, 1]
+    '''
+    def __init__(self, netG):
+        super(FoldedNetG, self).__init__()
+        self.n_z = netG.n_z
+        self.n_c = netG.n_c
+        self.lin_emb = copy.deepcopy(netG.lin_emb)
+        self.lin_zc = fold_linear_bn2d(netG.lin_zc, netG.emb_bn, 8*8)
+        self.convtr1 = fold_conv_bn(netG.convtr1, netG.convtr1_bn, transpose=True)
+        self.convtr2 = fold_conv_bn(netG.convtr2, netG.convtr2_bn, transpose=True)
+        self.convtr3 = fold_conv_bn(netG.convtr3, netG.convtr3_bn, transpose=True)
+        self.convtr4 = copy.deepcopy(netG.convtr4)
+        self.ReLU = nn.ReLU()
+        self.LeakyReLU = nn.LeakyReLU()
+        self.Tanh = nn.Tanh()
+
+    def forward(self, noise, skip_v):
+        emb = self.LeakyReLU(self.lin_emb(skip_v))
+        x = self.lin_zc(torch.cat([noise, emb], 1))
+        x = self.ReLU(x.view(x.size(0), 8*self.n_c, 8, 8))
+        x = self.ReLU(self.convtr1(x))
+        x = self.ReLU(self.convtr2(x))
+        x = self.ReLU(self.convtr3(x))
+        x = self.Tanh(self.convtr4(x))
+        return (x/2.0) + 0.5
+
+
+class FoldedNetD(nn.Module):
+    '''
+    NetD for inference: conv1-4_bn folded into their convs, no input noise.
+    Same output as NetD in eval mode: (real/fake score N x 1, class scores N x n_cls), after the sigmoid
+    '''
+    def __init__(self, netD):
+        super(FoldedNetD, self).__init__()
+        self.n_t = netD.n_t
+        self.n_f = netD.n_f
+        self.m_d = netD.m_d
+        self.conv1 = fold_conv_bn(netD.conv1, netD.conv1_bn)
+        self.conv2 = fold_conv_bn(netD.conv2, netD.conv2_bn)
+        self.conv3 = fold_conv_bn(netD.conv3, netD.conv3_bn)
+        self.conv4 = fold_conv_bn(netD.conv4, netD.conv4_bn)
+        self.conv5 = copy.deepcopy(netD.conv5)
+        self.fc_emb = copy.deepcopy(netD.fc_emb)
+        self.fc_t = copy.deepcopy(netD.fc_t)
+        self.fc_d = copy.deepcopy(netD.fc_d)
+        self.fc_c = copy.deepcopy(netD.fc_c)
+        self.LeakyReLU = nn.LeakyReLU()
+        self.Sigmoid = nn.Sigmoid()
+
+    def forward(self, image, skip_v):
+        x = self.LeakyReLU(self.conv1(image))
+        x = self.LeakyReLU(self.conv2(x))
+        x = self.LeakyReLU(self.conv3(x))
+        x = self.LeakyReLU(self.conv4(x))
+        emb = self.LeakyReLU(self.fc_emb(skip_v))
+        emb = emb.view(emb.size(0), self.n_t, 1, 1).expand(emb.size(0), self.n_t, self.m_d, self.m_d)
+        x = self.LeakyReLU(self.conv5(torch.cat([x, emb], 1)))
+        x = self.LeakyReLU(self.fc_t(x.reshape(x.size(0), self.m_d*self.m_d*self.n_f*8)))
+        return self.Sigmoid(self.fc_d(x)), self.Sigmoid(self.fc_c(x))
+
+
+def detect_model(checkpoint_path):
+    state = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    if 'netG' in state and 'netD' in state:
+        raise ValueError('{} is a full training checkpoint, pass --model netG or --model netD'.format(checkpoint_path))
+    return 'netG' if 'lin_zc.weight' in state else 'netD'
+
+
+def load_eager(checkpoint_path, model):
+    # eval-mode eager model, the reference for the exported one
+    if model == 'netG':
+        from serve import load_generator
+        return load_generator(checkpoint_path)
+    from screen_abuse import load_discriminator
+    return load_discriminator(checkpoint_path)
+
+
+def describe(model, eager):
+    # hyperparameters and input/output signature, written to the metadata sidecar
+    if model == 'netG':
+        hparams = {'n_z': eager.n_z, 'n_l': eager.n_l, 'n_t': eager.n_t, 'n_c': eager.n_c}
+        inputs = [{'name': 'noise', 'shape': ['batch', eager.n_z], 'dtype': 'float32'},
+                  {'name': 'docvec', 'shape': ['batch', eager.n_t], 'dtype': 'float32'}]
+        outputs = [{'name': 'image', 'shape': ['batch', 3, 128, 128], 'dtype': 'float32', 'range': [0, 1]}]
+        folded = ['lin_zc+emb_bn', 'convtr1+convtr1_bn', 'convtr2+convtr2_bn', 'convtr3+convtr3_bn']
+    else:
+        size = eager.m_d * 16
+        hparams = {'n_cls': eager.n_cls, 'n_t': eager.n_t, 'n_f': eager.n_f, 'docvec_size': eager.docvec_size,
+                   'm_d': eager.m_d}
+        inputs = [{'name': 'image', 'shape': ['batch', 3, size, size], 'dtype': 'float32', 'range': [0, 1]},
+                  {'name': 'docvec', 'shape': ['batch', eager.docvec_size], 'dtype': 'float32'}]
+        outputs = [{'name': 'real', 'shape': ['batch', 1], 'dtype': 'float32', 'range': [0, 1]},
+                   {'name': 'cls', 'shape': ['batch', eager.n_cls], 'dtype': 'float32', 'range': [0, 1]}]
+        folded = ['conv1+conv1_bn', 'conv2+conv2_bn', 'conv3+conv3_bn', 'conv4+conv4_bn']
+    return {'model': model, 'hparams': hparams, 'inputs': inputs, 'outputs': outputs, 'folded_batch_norm': folded}
+
+
+def sample_inputs(meta, batch_size, seed=0):
+    # noise and docvecs ~ N(0, 1), images ~ U(0, 1)
+    generator = torch.Generator().manual_seed(seed)
+    inputs = []
+    for spec in meta['inputs']:
+        shape = [batch_size] + spec['shape'][1:]
+        if 'range' in spec:
+            inputs.append(torch.rand(shape, generator=generator))
+        else:
+            inputs.append(torch.randn(shape, generator=generator))
+    return tuple(inputs)
+
+
+def as_tuple(outputs):
+    return outputs if isinstance(outputs, tuple) else (outputs,)
+
+
+def parity(eager, exported, meta, batch_size=16, atol=1e-4):
+    # largest absolute difference per output between the eager model and the exported one
+    inputs = sample_inputs(meta, batch_size)
+    with torch.inference_mode():
+        expected = as_tuple(eager(*inputs))
+        actual = as_tuple(exported(*inputs))
+    diffs = {spec['name']: float((e.float() - a.float()).abs().max())
+             for spec, e, a in zip(meta['outputs'], expected, actual)}
+    return {'batch_size': batch_size, 'atol': atol, 'max_abs_diff': diffs, 'ok': max(diffs.values()) <= atol}
+
+
+def latency(model, meta, batch_size, n_iter=20, n_warmup=3):
+    # median wall time of one forward pass in ms
+    inputs = sample_inputs(meta, batch_size)
+    times = []
+    with torch.inference_mode():
+        for i in range(n_warmup + n_iter):
+            st = time.perf_counter()
+            model(*inputs)
+            if i >= n_warmup:
+                times.append((time.perf_counter() - st) * 1000)
+    return float(np.median(times))
+
+
+def require_onnx():
+    try:
+        import onnx  # noqa: F401, needed by torch.onnx.export
+    except ImportError:
+        raise ImportError('ONNX export needs the onnx package (pip install onnx)')
+
+
+def export_onnx(folded, meta, path, opset=17):
+    input_names = [spec['name'] for spec in meta['inputs']]
+    output_names = [spec['name'] for spec in meta['outputs']]
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + output_names}
+    torch.onnx.export(folded, sample_inputs(meta, 2), path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False)
+
+
+def check_onnx(path, eager, meta, batch_size=16):
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    inputs = sample_inputs(meta, batch_size)
+    feed = {spec['name']: x.numpy() for spec, x in zip(meta['inputs'], inputs)}
+    with torch.inference_mode():
+        expected = as_tuple(eager(*inputs))
+    actual = session.run([spec['name'] for spec in meta['outputs']], feed)
+    return {spec['name']: float(np.abs(e.numpy() - a).max()) for spec, e, a in zip(meta['outputs'], expected, actual)}
+
+
+def sidecar_path(artifact):
+    return os.path.splitext(artifact)[0] + '.json'
+
+
+class ExportedModel(nn.Module):
+    '''
+    TorchScript model written by export.py or quantize.py, with the hyperparameters of its sidecar
+    as attributes (n_cls, docvec_size, m_d, ...), so it can be used in place of the eager model
+    '''
+    def __init__(self, module, meta):
+        super(ExportedModel, self).__init__()
+        self.module = module
+        self.meta = meta
+        for k, v in meta['hparams'].items():
+            setattr(self, k, v)
+
+    def forward(self, *inputs):
+        return self.module(*inputs)
+
+
+def load_exported(artifact, device='cpu'):
+    with open(sidecar_path(artifact)) as f:
+        meta = json.load(f)
+    if 'quantization' in meta:
+        if torch.device(device).type != 'cpu':
+            raise ValueError('{} is quantized and only runs on cpu'.format(artifact))
+        torch.backends.quantized.engine = meta['quantization']['backend']
+    return ExportedModel(torch.jit.load(artifact, map_location=device), meta).eval()
+
+
+def check(artifact, checkpoint, batch_sizes=(1, 64), threads=None, atol=1e-4):
+    """
+    Parity and CPU latency of an exported TorchScript model against the eager model of its checkpoint.
+    python export.py check exports/netG.pt <netG checkpoint> [--batch-sizes 1,64]
+    """
+    logger = get_logger()
+    if threads:
+        torch.set_num_threads(threads)
+    if isinstance(batch_sizes, int):
+        batch_sizes = (batch_sizes,)
+    with open(sidecar_path(artifact)) as f:
+        meta = json.load(f)
+    eager = load_eager(checkpoint, meta['model'])
+    exported = torch.jit.load(artifact, map_location='cpu')
+
+    result = {'parity': parity(eager, exported, meta, atol=atol), 'latency_ms': {}}
+    logger.info('parity %s: max abs diff %s' % ('ok' if result['parity']['ok'] else 'FAILED',
+                                                  result['parity']['max_abs_diff']))
+    for batch_size in batch_sizes:
+        eager_ms, exported_ms = latency(eager, meta, batch_size), latency(exported, meta, batch_size)
+        result['latency_ms'][str(batch_size)] = {'eager': eager_ms, 'torchscript': exported_ms}
+        logger.info('batch %d: eager %.2f ms, torchscript %.2f ms (%.2fx)' % (
+            batch_size, eager_ms, exported_ms, eager_ms / exported_ms))
+    if not result['parity']['ok']:
+        raise ValueError('{} does not match {}: {}'.format(artifact, checkpoint, result['parity']['max_abs_diff']))
+    return result
+
+
+def export(checkpoint, model=None, out_dir='exports', name=None, onnx=False, opset=17, batch_sizes=(1, 64),
+           threads=None):
+    """
+    Exports NetG or NetD for inference: BatchNorm folded into the preceding conv/linear layer, no input noise.
+    python export.py export <checkpoint> [--model netG|netD] [--out-dir exports] [--onnx]
+    Writes <out_dir>/<name>.pt (TorchScript), <name>.onnx with --onnx, and <name>.json with the
+    hyperparameters, the input/output signature and the parity/latency check against the eager model.
+    """
+    logger = get_logger()
+    model = model or detect_model(checkpoint)
+    if model not in MODELS:
+        raise ValueError('model should be one of {}: {}'.format(MODELS, model))
+    if onnx:
+        require_onnx()
+    name = name or model
+    os.makedirs(out_dir, exist_ok=True)
+
+    eager = load_eager(checkpoint, model)
+    folded = (FoldedNetG(eager) if model == 'netG' else FoldedNetD(eager)).eval()
+    meta = describe(model, eager)
+    meta.update(checkpoint=os.path.abspath(checkpoint), torch_version=torch.__version__, files={})
+
+    script_path = os.path.join(out_dir, name + '.pt')
+    torch.jit.save(torch.jit.freeze(torch.jit.script(folded)), script_path)
+    meta['files']['torchscript'] = os.path.basename(script_path)
+    if onnx:
+        onnx_path = os.path.join(out_dir, name + '.onnx')
+        export_onnx(folded, meta, onnx_path, opset)
+        meta['files']['onnx'] = os.path.basename(onnx_path)
+    meta_path = sidecar_path(script_path)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    meta.update(check(script_path, checkpoint, batch_sizes, threads))
+    if onnx:
+        meta['onnx_max_abs_diff'] = check_onnx(onnx_path, eager, meta)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info('%s -> %s' % (checkpoint, ', '.join(os.path.join(out_dir, f) for f in meta['files'].values())))
+
+
+if __name__ == '__main__':
+    fire.Fire({'export': export, 'check': check})
@@ -1,85 +1,225 @@
-import sys, os, multiprocessing, urllib3
+import os
+import zlib
+import fire
+import threading
+import urllib3
 from PIL import Image
 from io import BytesIO
 from tqdm import tqdm
-import gzip
 from multiprocessing.pool import ThreadPool
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
-def parse_data(path='data/datasets/products/products.tsv'):
-    key_url_list = []
+def parse_data(path='data/datasets/products/products.tsv', shard_index=0, n_shards=1):
+    """
+    Stream (asin, url) pairs from products.tsv, once per asin.
+    parse_metadata writes every product N_SHUFFLE times (one row per title), so repeated asins are skipped.
+    With n_shards > 1 only the asins with crc32(asin) % n_shards == shard_index are yielded.
+    """
+    seen = set()
+    last = None
     with open(path) as f:
-        for i, l in enumerate(f):
+        for l in f:
             row = l.split('\t')
             asin = row[0]
+            # rows of one product are consecutive, so most duplicates are caught without the set lookup
+            if asin == last:
+                continue
+            last = asin
+            # filter before the set, so a shard only remembers the asins it owns
+            if n_shards > 1 and zlib.crc32(asin.encode('utf-8')) % n_shards != shard_index:
+                continue
+            if asin in seen:
+                continue
+            seen.add(asin)
             url = row[3].strip() if len(row) > 3 else None
-            if i % 10000 == 0:
-                print('read lines: {}'.format(i))
-
-            key_url_list.append((asin, url))
-            if i % 1000 == 0:
-                print(i,row)
-
-    return key_url_list
-
-
-def download_image(key_url):
-    outdir = sys.argv[2]
-    key, url = key_url
-    filename = os.path.join(outdir, '%s.jpg' % key)
-
-    if os.path.exists(filename):
-        print('Image %s already exists. Skipping download.' % filename)
-        return
-
-    try:
-        # print('Trying to get %s.' % url)
-        http = urllib3.PoolManager()
-        response = http.request('GET', url)
-        image_data = response.data
-    except Exception as e:
-        print(e)
-        print('Warning: Could not download image %s from %s' % (key, url))
-        return
-
-    try:
-        pil_image = Image.open(BytesIO(image_data))
-    except:
-        print('Warning: Failed to parse image %s %s' % (key, url))
-        return
-
-    try:
-        pil_image_rgb = pil_image.convert('RGB')
-    except:
-        print('Warning: Failed to convert image %s to RGB' % key)
-        return
-
-    try:
-        pil_image_rgb.save(filename, format='JPEG')
-    except:
-        print('Warning: Failed to save image %s' % filename)
-        return
-
-
-def run():
-    if len(sys.argv) != 3:
-        print('Syntax: %s <train|validation|test.json> <output_dir/>' % sys.argv[0])
-        sys.exit(0)
-
-    data_file, out_dir = sys.argv[1:]
+            yield asin, url
+
+
+class ImageDownloader:
+    '''
+    out_dir       : directory the <asin>.jpg images are written to
+    n_threads     : number of concurrent downloads (also the connection pool size per host)
+    retries       : retries per image on connection errors and 429/5xx, with exponential backoff
+    backoff       : backoff factor in seconds (backoff * 2^(retry-1) between tries)
+    timeout       : connect/read timeout in seconds
+    manifest_path : append-only tsv of finished asins (asin, ok|fail, message). By default: <out_dir>/manifest.tsv
+    retry_failed  : download the asins marked as failed in the manifest again
+    passthrough   : write the downloaded bytes as is when they already are an RGB JPEG (no re-encode)
+    thumb_size    : also write a thumb_size x thumb_size copy for training (0: off), decoded with
+                    JPEG draft mode (reduce-on-decode) when possible
+    thumb_dir     : directory of the training copies. By default: <out_dir>_<thumb_size>
+    '''
+    def __init__(self, out_dir, n_threads=200, retries=3, backoff=0.5, timeout=10.0, manifest_path=None,
+                 retry_failed=False, passthrough=True, thumb_size=0, thumb_dir=None):
+        self.out_dir = out_dir
+        self.passthrough = passthrough
+        self.thumb_size = thumb_size
+        self.thumb_dir = thumb_dir or '%s_%d' % (out_dir.rstrip('/'), thumb_size)
+        if self.thumb_size > 0:
+            os.makedirs(self.thumb_dir, exist_ok=True)
+        self.n_threads = n_threads
+        self.manifest_path = manifest_path or os.path.join(out_dir, 'manifest.tsv')
+        self.retry_failed = retry_failed
+
+        # one thread-safe pool manager for all threads: keep-alive connections are reused per host
+        retry = urllib3.Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                              raise_on_status=False)
+        self.http = urllib3.PoolManager(num_pools=64, maxsize=n_threads, block=True, retries=retry,
+                                        timeout=urllib3.Timeout(connect=timeout, read=timeout))
+
+        self.done = self.load_manifest()
+        self.manifest_lock = threading.Lock()
+        self.manifest = open(self.manifest_path, 'a', buffering=1)
+
+    def load_manifest(self):
+        done = set()
+        if not os.path.exists(self.manifest_path):
+            # first run on an existing image dir: one listing instead of a stat per image
+            for entry in os.scandir(self.out_dir):
+                if entry.name.endswith('.jpg'):
+                    done.add(entry.name[:-len('.jpg')])
+            return done
+
+        with open(self.manifest_path) as f:
+            for line in f:
+                row = line.rstrip('\n').split('\t')
+                if len(row) < 2:
+                    continue  # torn last line of an interrupted run
+                if row[1] == 'ok' or not self.retry_failed:
+                    done.add(row[0])
+                else:
+                    done.discard(row[0])
+        return done
+
+    def record(self, key, status, message=''):
+        with self.manifest_lock:
+            self.manifest.write('%s\t%s\t%s\n' % (key, status, message.replace('\t', ' ').replace('\n', ' ')))
+
+    def fetch(self, url):
+        response = self.http.request('GET', url, preload_content=True)
+        if response.status != 200:
+            raise IOError('HTTP %d' % response.status)
+        return response.data
+
+    def download_image(self, key_url):
+        key, url = key_url
+        filename = os.path.join(self.out_dir, '%s.jpg' % key)
+
+        if not url:
+            self.record(key, 'fail', 'no url')
+            return 'fail'
+
+        try:
+            image_data = self.fetch(url)
+        except Exception as e:
+            print('Warning: Could not download image %s from %s (%s)' % (key, url, e))
+            self.record(key, 'fail', 'download: %s' % e)
+            return 'fail'
+
+        try:
+            pil_image = Image.open(BytesIO(image_data))
+        except:
+            print('Warning: Failed to parse image %s %s' % (key, url))
+            self.record(key, 'fail', 'parse')
+            return 'fail'
+
+        # Image.open only reads the header, the pixels are decoded below only if needed
+        if self.passthrough and pil_image.format == 'JPEG' and pil_image.mode == 'RGB':
+            try:
+                with open(filename, 'wb') as f:
+                    f.write(image_data)
+            except:
+                print('Warning: Failed to save image %s' % filename)
+                self.record(key, 'fail', 'save')
+                return 'fail'
+            pil_image_rgb = None
+        else:
+            try:
+                pil_image_rgb = pil_image.convert('RGB')
+            except:
+                print('Warning: Failed to convert image %s to RGB' % key)
+                self.record(key, 'fail', 'convert')
+                return 'fail'
+
+            try:
+                pil_image_rgb.save(filename, format='JPEG')
+            except:
+                print('Warning: Failed to save image %s' % filename)
+                self.record(key, 'fail', 'save')
+                return 'fail'
+
+        if self.thumb_size > 0:
+            try:
+                self.save_thumb(key, pil_image if pil_image_rgb is None else pil_image_rgb)
+            except:
+                print('Warning: Failed to save the %d image of %s' % (self.thumb_size, key))
+                self.record(key, 'fail', 'thumb')
+                return 'fail'
+
+        self.record(key, 'ok')
+        return 'ok'
+
+    def save_thumb(self, key, pil_image):
+        size = (self.thumb_size, self.thumb_size)
+        if pil_image.format == 'JPEG':
+            # not decoded yet: let libjpeg decode at 1/2, 1/4 or 1/8 scale (still >= size)
+            pil_image.draft('RGB', size)
+        thumb = pil_image.convert('RGB').resize(size, Image.BILINEAR)
+        thumb.save(os.path.join(self.thumb_dir, '%s.jpg' % key), format='JPEG', quality=95)
+
+    def run(self, key_url_list):
+        """
+        key_url_list : any iterable of (asin, url), e.g. the parse_data generator. It is consumed lazily and
+                       at most 2 * n_threads downloads are queued ahead of the workers.
+        """
+        counts = {'total': 0, 'done': 0}
+        slots = threading.BoundedSemaphore(2 * self.n_threads)
+
+        def feed():
+            for key_url in key_url_list:
+                counts['total'] += 1
+                if key_url[0] in self.done:
+                    counts['done'] += 1
+                    continue
+                slots.acquire()
+                yield key_url
+
+        pool = ThreadPool(processes=self.n_threads)
+        n_ok, n_fail = 0, 0
+        with tqdm(unit='img') as t:
+            for status in pool.imap_unordered(self.download_image, feed()):
+                slots.release()
+                n_ok += status == 'ok'
+                n_fail += status == 'fail'
+                t.update(1)
+                t.set_postfix(skipped=counts['done'], failed=n_fail, refresh=False)
+        pool.close()
+        pool.join()
+        self.manifest.close()
+        print('images: %d, already done: %d, downloaded: %d, failed: %d' % (counts['total'], counts['done'], n_ok, n_fail))
+
+
+def run(data_file, out_dir, n_threads=200, retries=3, backoff=0.5, timeout=10.0, manifest=None, retry_failed=False,
+        passthrough=True, thumb_size=0, thumb_dir=None, shard_index=0, n_shards=1):
+    """
+    python image_downloader.py <products.tsv> <output_dir/> [--n-threads 200] [--retry-failed]
+                               [--nopassthrough] [--thumb-size 128 [--thumb-dir <dir>]]
+                               [--shard-index i --n-shards n]
+    """
+    if not 0 <= shard_index < n_shards:
+        raise ValueError('shard_index should be in [0, n_shards): %d, %d' % (shard_index, n_shards))
     if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
+        os.makedirs(out_dir)
 
-    key_url_list = parse_data(data_file)
+    key_url_list = parse_data(data_file, shard_index=shard_index, n_shards=n_shards)
 
-    pool = ThreadPool(processes=20)
-
-    with tqdm(total=len(key_url_list)) as t:
-        for _ in pool.imap_unordered(download_image, key_url_list):
-            t.update(1)
+    downloader = ImageDownloader(out_dir, n_threads=n_threads, retries=retries, backoff=backoff, timeout=timeout,
+                                 manifest_path=manifest, retry_failed=retry_failed, passthrough=passthrough,
+                                 thumb_size=thumb_size, thumb_dir=thumb_dir)
+    downloader.run(key_url_list)
 
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    fire.Fire(run)
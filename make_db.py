@@ -1,37 +1,39 @@
 import os
+import json
 import fire
 import time
 import sys
 import traceback
+import uuid
 from sklearn.externals import joblib
 import random
 import h5py
 import numpy as np
-from misc import get_logger, ges_Aonfig
+from PIL import Image
+from misc import get_logger, ges_Aonfig, save_valid_mask, load_valid_mask, load_image_array, \
+    get_build_id
 from parse_metadata import EcommerceDataParser
 
 from multiprocessing import Pool
 from functools import partial
-from six.moves import cPickle
 
-def one_hot_encode_str_lbl(lbl, target, one_hot_targets):
+def encode_str_lbl(lbl, target2idx):
     """
-    Encodes a string label into one-hot encoding
+    Encodes a string label into its class index
 
     Example:
         input: "window"
-        output: [0 0 0 0 0 0 1 0 0 0 0 0]
-    the length would depend on the number of classes in the dataset. The
-    above is just a random example.
+        output: 6
+    The one-hot vector the classifier is trained against is built from this
+    index batch-wise on the training device (see TACGAN.trainEpoch).
 
     :param lbl: The string label
-    :return: one-hot encoding
+    :return: class index
     """
-    idx = target.index(lbl)
-    return one_hot_targets[idx]
+    return target2idx[lbl]
 
 
-def get_one_hot_targets(target_file_path):
+def get_targets(target_file_path):
     target = []
     n_target = 0
     try :
@@ -49,11 +51,64 @@ def get_one_hot_targets(target_file_path):
               'the labels.')
         traceback.print_stack()
 
-    lbl_idxs = np.arange(n_target)
-    one_hot_targets = np.zeros((n_target, n_target))
-    one_hot_targets[np.arange(n_target), lbl_idxs] = 1
+    target2idx = {t: i for i, t in enumerate(target)}
 
-    return target, one_hot_targets, n_target
+    return target, target2idx, n_target
+
+
+def check_images(args):
+    image_paths, image_size = args
+    valid = np.zeros(len(image_paths), dtype=np.bool_)
+    for i, image_path in enumerate(image_paths):
+        try:
+            image = Image.open(image_path)
+            image.draft('RGB', (image_size, image_size))
+            image.convert('RGB')
+            valid[i] = True
+        except Exception:
+            pass
+    return valid
+
+
+def decode_shard(args):
+    # decodes straight into a temp .npy next to the shard, only the validity goes back to the parent
+    shard_path, image_paths, image_size = args
+    tmp_path = shard_path + '.tmp.npy'
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=(len(image_paths), 3, image_size, image_size))
+    valid = np.zeros(len(image_paths), dtype=np.bool_)
+    for i, image_path in enumerate(image_paths):
+        try:
+            images[i] = load_image_array(image_path, image_size)
+            valid[i] = True
+        except Exception:
+            pass  # the memmap is zero filled
+    images.flush()
+    del images
+    return shard_path, tmp_path, valid
+
+
+_vec_parser = None
+
+
+def init_vec_worker(parse_config):
+    # every worker process loads its own spm + doc2vec, arrays are mmap'ed and shared
+    global _vec_parser
+    _vec_parser = EcommerceDataParser(parse_config)
+    _vec_parser.load_spm()
+    _vec_parser.load_doc2vec_model(mmap='r')
+
+
+def vectorize_chunk(args):
+    index, titles = args
+    vecs = _vec_parser.text2vec_batch(titles)
+    # pool workers exit without a close, one cache commit per chunk
+    _vec_parser.flush_text2vec_cache()
+    return index, vecs
+
+
+def shard_path(shard_dir, div, index):
+    return os.path.join(shard_dir, '{}_{:05d}.npy'.format(div, index))
 
 
 class eCommerceData:
@@ -65,36 +120,68 @@ class eCommerceData:
         self.doc_vec_size = config['PARSEMETA']['DOC_VEC_SIZE']
         self.train_dir_path = config['MAKEDB']['TRAIN_DIR_PATH']
         self.chunk_size = config['MAKEDB']['CHUNK_SIZE']
-        self.temp_dir_path = config['MAKEDB']['TEMP_DIR_PATH']
-
-        self.parser = EcommerceDataParser(config['PARSEMETA'], use=True)
-
-    def get_train_indices(self, size, train_ratio):
-        train_indices = np.random.rand(size) < train_ratio
+        self.image_dir_path = config['MAKEDB']['IMAGE_DIR_PATH']
+        self.image_size = config['MAKEDB']['IMAGE_SIZE']
+        self.shard_size = config['MAKEDB']['SHARD_SIZE']
+        self.n_workers = config['MAKEDB']['N_WORKERS']
+        self.n_vec_workers = config['MAKEDB']['N_VEC_WORKERS']
+
+        self.config = config
+        self._parser = None
+
+    @property
+    def parser(self):
+        # only the caption vectorizer needs spm/doc2vec, image shards do not
+        if self._parser is None:
+            self._parser = EcommerceDataParser(self.config['PARSEMETA'], use=True)
+        return self._parser
+
+    def get_train_indices(self, size, train_ratio, seed):
+        train_indices = np.random.RandomState(seed).rand(size) < train_ratio
         train_size = int(np.count_nonzero(train_indices))
         return train_indices, train_size
 
-    def create_dataset(self, g, size, num_classes):
-        g.create_dataset('docvec', (size, self.doc_vec_size), chunks=True, dtype=np.float32)
-        g.create_dataset('cate', (size, num_classes), chunks=True, dtype=np.int32)
-        g.create_dataset('asin', (size,), chunks=True, dtype='S14')
-
-    def init_chunk(self, chunk_size, num_classes):
-        chunk = {}
-        chunk['docvec'] = np.zeros(shape=(chunk_size, self.doc_vec_size), dtype=np.float32)
-        chunk['cate'] = np.zeros(shape=(chunk_size, num_classes), dtype=np.int32)
-        chunk['asin'] = []
-        chunk['num'] = 0
-        return chunk
-
-    def copy_chunk(self, dataset, chunk, offset):
-        num = chunk['num']
-        dataset['docvec'][offset:offset + num] = chunk['docvec'][:num]
-        dataset['cate'][offset:offset + num] = chunk['cate'][:num]
-        dataset['asin'][offset:offset + num] = chunk['asin'][:num]
-
-    def save_caption_vectors_products(self, train_ratio=0.8):
-        target, one_hot_targets, n_target = get_one_hot_targets(self.category_path)
+    def create_dataset(self, g, num_classes):
+        # resizable, chunks are appended as they are vectorized
+        g.create_dataset('docvec', (0, self.doc_vec_size), maxshape=(None, self.doc_vec_size), chunks=True, dtype=np.float32)
+        g.create_dataset('cate', (0,), maxshape=(None,), chunks=True, dtype=np.int32)
+        g.attrs['num_classes'] = num_classes
+        g.create_dataset('asin', (0,), maxshape=(None,), chunks=True, dtype='S14')
+
+    def append_chunk(self, dataset, asins, cates, docvecs):
+        offset = dataset['asin'].shape[0]
+        num = len(asins)
+        if num == 0:
+            return
+        for key in ['asin', 'cate', 'docvec']:
+            dataset[key].resize(offset + num, axis=0)
+        dataset['asin'][offset:offset + num] = asins
+        dataset['cate'][offset:offset + num] = cates
+        dataset['docvec'][offset:offset + num] = docvecs
+
+    def load_build_state(self, state_path, datasize, train_ratio):
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path) as f:
+            state = json.load(f)
+        if state['done'] or state['datasize'] != datasize or state['train_ratio'] != train_ratio \
+                or state['chunk_size'] != self.chunk_size:
+            return None
+        return state
+
+    def save_build_state(self, state_path, state):
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def save_caption_vectors_products(self, train_ratio=0.8, seed=None, resume=True):
+        """
+        Vectorizes products.tsv chunk by chunk and appends each chunk straight into the
+        train/dev groups of data.h5py. After every committed chunk the build state is saved
+        to data.h5py.state.json, so an interrupted build resumes from the next chunk.
+        """
+        target, target2idx, n_target = get_targets(self.category_path)
 
         train_list = []
         with open(self.parse_data_path) as cap_f:
@@ -104,8 +191,8 @@ class eCommerceData:
                 categories = row[1]
                 title = row[2]
                 imgid = asin+'.jpg'
-                onehot_cate = one_hot_encode_str_lbl(categories, target, one_hot_targets)
-                train_list.append((imgid, onehot_cate, title))
+                cate = encode_str_lbl(categories, target2idx)
+                train_list.append((imgid, cate, title))
 
                 if i % self.n_log_print == 0:
                     print(i, train_list[-1])
@@ -115,100 +202,164 @@ class eCommerceData:
         self.logger.info('data size: %d' % datasize)
         n_chunk = datasize // chunk_size + 1
 
-        chunk_list = []
-        for index in range(n_chunk):
-            start_index = index * chunk_size
-            end_index = start_index + chunk_size
-            chunk = train_list[start_index:end_index]
-            chunk_list.append((index, chunk))
+        if not os.path.isdir(self.train_dir_path):
+            os.makedirs(self.train_dir_path)
 
-        for chunk in chunk_list:
-            index = chunk[0]
-            chunk = chunk[1]
+        data_path = os.path.join(self.train_dir_path, 'data.h5py')
+        state_path = data_path + '.state.json'
+        state = self.load_build_state(state_path, datasize, train_ratio) if resume else None
+        if state is not None and os.path.exists(data_path):
+            self.logger.info('resume from chunk %d/%d' % (state['next_chunk'], n_chunk))
+            data_fout = h5py.File(data_path, 'a')
+            dataset = {div: data_fout[div] for div in ['train', 'dev']}
+            # drop rows written after the last committed chunk
+            for div in ['train', 'dev']:
+                for key in ['asin', 'cate', 'docvec']:
+                    dataset[div][key].resize(state['num_samples'][div], axis=0)
+        else:
+            state = {'datasize': datasize, 'train_ratio': train_ratio, 'chunk_size': chunk_size,
+                     'seed': int(np.random.randint(2 ** 31 - 1)) if seed is None else seed,
+                     'next_chunk': 0, 'num_samples': {'train': 0, 'dev': 0}, 'done': False}
+            data_fout = h5py.File(data_path, 'w')
+            # rows are reshuffled, masks and shards of the previous db are tied to it by this id
+            data_fout.attrs['build_id'] = uuid.uuid4().hex
+            for div in ['train', 'dev']:
+                stale_path = os.path.join(self.train_dir_path, 'valid_{}.npz'.format(div))
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            dataset = {div: data_fout.create_group(div) for div in ['train', 'dev']}
+            for div in ['train', 'dev']:
+                self.create_dataset(dataset[div], n_target)
+            self.save_build_state(state_path, state)
+
+        # the split is drawn from the saved seed, so it is the same after a resume
+        train_indices, _ = self.get_train_indices(datasize, train_ratio, state['seed'])
+        if train_ratio >= 1.0:
+            train_indices[:] = True
+        if train_ratio == 0.0:
+            train_indices[:] = False
+
+        # chunks are vectorized in a process pool, imap keeps them in chunk order
+        pool = Pool(self.n_vec_workers, initializer=init_vec_worker, initargs=(self.config['PARSEMETA'],))
+        title_chunks = ((index, [title for _, _, title in train_list[index * chunk_size:(index + 1) * chunk_size]])
+                        for index in range(state['next_chunk'], n_chunk))
+        st = time.time()
+        for index, title_vecs in pool.imap(vectorize_chunk, title_chunks):
+            start_index = index * chunk_size
+            chunk = train_list[start_index:start_index + chunk_size]
+            is_train = train_indices[start_index:start_index + len(chunk)]
+            for div, mask in [('train', is_train), ('dev', ~is_train)]:
+                rows = np.flatnonzero(mask)
+                self.append_chunk(dataset[div],
+                                  [np.bytes_(chunk[r][0]) for r in rows],
+                                  np.asarray([chunk[r][1] for r in rows], dtype=np.int32),
+                                  np.asarray([title_vecs[r] for r in rows], dtype=np.float32).reshape(-1, self.doc_vec_size))
+                state['num_samples'][div] += len(rows)
+
+            data_fout.flush()
+            state['next_chunk'] = index + 1
+            self.save_build_state(state_path, state)
+            self.logger.info("chunk %d/%d done: %d" % (index + 1, n_chunk, time.time() - st))
             st = time.time()
-            temp_list = []
-            for i, (key, cate_vec, title) in enumerate(chunk):
+        pool.close()
+        pool.join()
 
-                title_vec = self.parser.text2vec(title)
-                temp_list.append((key, cate_vec, title_vec))
+        data_fout.close()
+        state['done'] = True
+        self.save_build_state(state_path, state)
+        self.logger.info('train: %d, dev: %d' % (state['num_samples']['train'], state['num_samples']['dev']))
+
+    def make_valid_index(self, n_per_job=1000):
+        """
+        Checks in parallel that the image of every row of data.h5py can be decoded and saves
+        a bitmap of the valid rows to <TRAIN_DIR_PATH>/valid_<div>.npz. ImTextDataset only
+        draws from these rows, so training never has to retry a missing image.
+        """
+        with h5py.File(os.path.join(self.train_dir_path, 'data.h5py'), 'r') as data:
+            asins = {div: [a.decode('utf-8') for a in data[div]['asin'][:]] for div in ['train', 'dev']}
+            build_id = get_build_id(data)
+
+        pool = Pool(self.n_workers)
+        for div in ['train', 'dev']:
+            st = time.time()
+            paths = [os.path.join(self.image_dir_path, asin) for asin in asins[div]]
+            jobs = [(paths[i:i + n_per_job], self.image_size) for i in range(0, len(paths), n_per_job)]
+            valid = np.concatenate(list(pool.imap(check_images, jobs)) or [np.zeros(0, dtype=np.bool_)])
+            save_valid_mask(os.path.join(self.train_dir_path, 'valid_{}.npz'.format(div)), valid, build_id)
+            self.logger.info('%s valid images: %d/%d [%d sec]' % (div, valid.sum(), len(valid), time.time() - st))
+        pool.close()
+        pool.join()
+
+    def make_image_shards(self):
+        """
+        Decodes and resizes every image of data.h5py once into fixed-shape uint8 arrays
+        (N, 3, IMAGE_SIZE, IMAGE_SIZE) saved as .npy shards of SHARD_SIZE rows, in the same
+        row order as the train/dev groups. Rows whose image could not be decoded are zero
+        filled and marked False in <div>_valid.npz. Existing shards are kept, so an
+        interrupted build resumes, as long as <div>_valid.npz was written for the same
+        data.h5py (row count and build id); shards of another db are deleted and rebuilt.
+        """
+        shard_dir = os.path.join(self.train_dir_path, 'shards_{}'.format(self.image_size))
+        os.makedirs(shard_dir, exist_ok=True)
+
+        with h5py.File(os.path.join(self.train_dir_path, 'data.h5py'), 'r') as data:
+            asins = {div: [a.decode('utf-8') for a in data[div]['asin'][:]] for div in ['train', 'dev']}
+            build_id = get_build_id(data)
+
+        pool = Pool(self.n_workers)
+        for div in ['train', 'dev']:
+            size = len(asins[div])
+            n_shard = (size + self.shard_size - 1) // self.shard_size
+            valid_path = os.path.join(shard_dir, '{}_valid.npz'.format(div))
+            valid = None
+            if os.path.exists(valid_path):
+                try:
+                    valid = load_valid_mask(valid_path, size, build_id)
+                except ValueError as e:
+                    self.logger.info('rebuilding the %s shards: %s' % (div, e))
+            if valid is None:
+                # shards without a matching mask hold the rows of another db
+                for name in os.listdir(shard_dir):
+                    if name.startswith(div + '_') and name.endswith('.npy'):
+                        os.remove(os.path.join(shard_dir, name))
+                valid = np.zeros(size, dtype=np.bool_)
+
+            jobs = []
+            for index in range(n_shard):
+                path = shard_path(shard_dir, div, index)
+                if os.path.exists(path):
+                    continue
+                rows = asins[div][index * self.shard_size:(index + 1) * self.shard_size]
+                jobs.append((path, [os.path.join(self.image_dir_path, asin) for asin in rows], self.image_size))
 
-            chunk_path = (os.path.join(self.temp_dir_path, 'products_tv_{}.pkl'.format(index)))
-            f_out = open(chunk_path, 'wb')
-            p = cPickle.Pickler(f_out)
-            p.dump(temp_list)
-            p.clear_memo()
-            f_out.close()
+            st = time.time()
+            for path, tmp_path, shard_valid in pool.imap_unordered(decode_shard, jobs):
+                index = int(os.path.basename(path)[len(div) + 1:-4])
+                # the mask is saved before the shard is published: an existing shard always has its rows
+                # in the mask, a crash in between only rebuilds the shard
+                valid[index * self.shard_size:index * self.shard_size + len(shard_valid)] = shard_valid
+                save_valid_mask(valid_path, valid, build_id)
+                os.replace(tmp_path, path)
+                self.logger.info('%s done: %d valid/%d [%d sec]' % (path, shard_valid.sum(), len(shard_valid), time.time() - st))
 
-            self.logger.info("%s done: %d" % (chunk_path, time.time() - st))
+            save_valid_mask(valid_path, valid, build_id)
+            self.logger.info('%s shards: %d, valid images: %d/%d' % (div, n_shard, valid.sum(), size))
+        pool.close()
+        pool.join()
 
-        if not os.path.isdir(self.train_dir_path):
-            os.makedirs(self.train_dir_path)
 
-        all_train = train_ratio >= 1.0
-        all_dev = train_ratio == 0.0
-
-        train_indices, train_size = self.get_train_indices(datasize, train_ratio)
-
-        dev_size = datasize - train_size
-        if all_dev:
-            train_size = 1
-            dev_size = datasize
-        if all_train:
-            dev_size = 1
-            train_size = datasize
-
-        data_fout = h5py.File(os.path.join(self.train_dir_path, 'data.h5py'), 'w')
-        train = data_fout.create_group('train')
-        dev = data_fout.create_group('dev')
-        self.create_dataset(train, train_size, n_target)
-        self.create_dataset(dev, dev_size, n_target)
-
-        sample_idx = 0
-        dataset = {'train': train, 'dev': dev}
-        num_samples = {'train': 0, 'dev': 0}
-        chunk = {'train': self.init_chunk(chunk_size, n_target),
-                 'dev': self.init_chunk(chunk_size, n_target)}
-
-        # make h5file
-        for input_chunk_idx in range(n_chunk):
-            path = os.path.join(self.temp_dir_path, 'products_tv_{}.pkl'.format(input_chunk_idx))
-            print('processing %s ...' % path)
-            data = cPickle.loads(open(path, 'rb').read())
-            for data_idx, (img_idx, cate_vec, title_vec) in enumerate(data):
-
-                is_train = train_indices[sample_idx + data_idx]
-                if all_dev:
-                    is_train = False
-                if all_train:
-                    is_train = True
-
-                c = chunk['train'] if is_train else chunk['dev']
-                idx = c['num']
-                c['docvec'][idx] = title_vec
-                c['cate'][idx] = cate_vec
-                c['asin'].append(np.string_(img_idx))
-                c['num'] += 1
-
-                for t in ['train', 'dev']:
-                    if chunk[t]['num'] >= chunk_size:
-                        self.copy_chunk(dataset[t], chunk[t], num_samples[t])
-                        num_samples[t] += chunk[t]['num']
-                        chunk[t] = self.init_chunk(chunk_size, n_target)
-
-            sample_idx += len(data)
-
-        for t in ['train', 'dev']:
-            if chunk[t]['num'] > 0:
-                self.copy_chunk(dataset[t], chunk[t], num_samples[t])
-                num_samples[t] += chunk[t]['num']
+def check_images_main(servertype):
+    config_path = './configs/config-{}.yaml'.format(servertype)
+    config = ges_Aonfig(config_path)
+    data = eCommerceData(config)
+    data.make_valid_index()
 
-        for div in ['train', 'dev']:
-            ds = dataset[div]
-            size = num_samples[div]
-            ds['cate'].resize((size, n_target))
-            ds['docvec'].resize((size, self.doc_vec_size))
 
-        data_fout.close()
+def make_shards(servertype):
+    config_path = './configs/config-{}.yaml'.format(servertype)
+    config = ges_Aonfig(config_path)
+    data = eCommerceData(config)
+    data.make_image_shards()
 
 
 def main(servertype, dataset):
@@ -223,4 +374,4 @@ def main(servertype, dataset):
 
 if __name__ == '__main__':
 
-    fire.Fire({"make_db": main})
\ No newline at end of file
+    fire.Fire({"make_db": main, "make_shards": make_shards, "check_images": check_images_main})
\ No newline at end of file
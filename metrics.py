@@ -0,0 +1,153 @@
+import csv
+import json
+from time import perf_counter
+from contextlib import contextmanager
+
+
+STEP_PHASES = ['data', 'd_step', 'g_step']
+
+
+class TrainMetrics():
+    '''
+    path      : structured log written every log_every steps, JSON lines (.jsonl) or CSV (.csv). None: no file
+    log_every : number of steps aggregated into one record
+    tb_dir    : directory for TensorBoard scalars (needs the tensorboard package). None: off
+    sync      : called before every clock read, e.g. torch.cuda.synchronize so that the time of
+                asynchronous cuda kernels is attributed to the phase that launched them. It stalls the host
+                several times per step, so train.py only passes it with --metrics-sync. Without it the phases
+                on cuda measure host time, and the kernels show up in whichever phase waits for them
+
+    Usage per step:
+        metrics.start_epoch(epoch)
+        for batch in loader:
+            metrics.phase('data')    # time waited for the batch
+            ...                       # D update
+            metrics.phase('d_step')
+            ...                       # G update
+            metrics.phase('g_step')
+            record = metrics.end_step(batch_size, loss_d=..., loss_g=...)  # aggregated record or None
+        summary = metrics.end_epoch()
+    '''
+    def __init__(self, path=None, log_every=50, tb_dir=None, sync=None):
+        self.path = path
+        self.log_every = max(1, log_every)
+        self.sync = sync
+        self.global_step = 0
+        self.file = None
+        self.csv = None
+        if path:
+            self.file = open(path, 'a', buffering=1)
+        self.tb = None
+        if tb_dir:
+            try:
+                from torch.utils.tensorboard import SummaryWriter
+            except ImportError:
+                raise ImportError('TensorBoard scalars need the tensorboard package (pip install tensorboard)')
+            self.tb = SummaryWriter(tb_dir)
+        self.start_epoch(0)
+
+    def clock(self):
+        if self.sync is not None:
+            self.sync()
+        return perf_counter()
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.step = 0
+        self.window = self.new_totals()
+        self.totals = self.new_totals()
+        self.last = self.clock()
+
+    def new_totals(self):
+        totals = {k: 0.0 for k in STEP_PHASES}
+        totals.update(steps=0, samples=0, losses={})
+        return totals
+
+    def phase(self, name):
+        # time since the previous mark goes to the phase that just ended
+        now = self.clock()
+        for totals in (self.window, self.totals):
+            totals[name] += now - self.last
+        self.last = now
+
+    def end_step(self, n_samples, **losses):
+        for totals in (self.window, self.totals):
+            totals['steps'] += 1
+            totals['samples'] += n_samples
+            for k, v in losses.items():
+                totals['losses'][k] = totals['losses'].get(k, 0.0) + float(v)
+        self.step += 1
+        self.global_step += 1
+        if self.window['steps'] >= self.log_every:
+            return self.flush()
+        return None
+
+    def aggregate(self, totals):
+        steps = max(1, totals['steps'])
+        step_time = sum(totals[k] for k in STEP_PHASES)
+        record = {'epoch': self.epoch, 'step': self.step, 'global_step': self.global_step, 'steps': totals['steps'],
+                  'summary': False}
+        for k in STEP_PHASES:
+            record[k + '_time'] = totals[k] / steps
+        record['step_time'] = step_time / steps
+        record['data_wait'] = totals['data'] / step_time if step_time > 0 else 0.0
+        record['samples_per_sec'] = totals['samples'] / step_time if step_time > 0 else 0.0
+        for k, v in totals['losses'].items():
+            record[k] = v / steps
+        return record
+
+    def flush(self):
+        # aggregate the steps since the last record and write it out
+        if self.window['steps'] == 0:
+            return None
+        record = self.aggregate(self.window)
+        self.write(record)
+        if self.tb is not None:
+            for k, v in record.items():
+                if k not in ('epoch', 'step', 'global_step', 'steps', 'summary'):
+                    self.tb.add_scalar('train/' + k, v, self.global_step)
+        self.window = self.new_totals()
+        return record
+
+    def write(self, record):
+        if self.file is None:
+            return
+        if self.path.endswith('.csv'):
+            if self.csv is None:
+                self.csv = csv.DictWriter(self.file, fieldnames=list(record.keys()), extrasaction='ignore')
+                if self.file.tell() == 0:
+                    self.csv.writeheader()
+            self.csv.writerow(record)
+        else:
+            self.file.write(json.dumps(record) + '\n')
+
+    @contextmanager
+    def timed(self, name):
+        # time an event outside the steps (e.g. checkpointing), logged as its own record
+        start = self.clock()
+        yield
+        seconds = self.clock() - start
+        if self.file is not None and not self.path.endswith('.csv'):
+            self.file.write(json.dumps({'epoch': self.epoch, 'global_step': self.global_step,
+                                        'event': name, 'time': seconds}) + '\n')
+        if self.tb is not None:
+            self.tb.add_scalar('time/' + name, seconds, self.global_step)
+        self.last = self.clock() # not counted as data wait of the next step
+
+    def end_epoch(self):
+        # summary over the whole epoch, also written as a record with summary set
+        self.flush()
+        summary = self.aggregate(self.totals)
+        summary['summary'] = True
+        self.write(summary)
+        if self.tb is not None:
+            self.tb.flush()
+        return summary
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.tb is not None:
+            self.tb.close()
+            self.tb = None
@@ -1,4 +1,6 @@
+import os
 import yaml
+import numpy as np
 
 
 def get_logger(name=__file__):
@@ -21,4 +23,38 @@ def get_logger(name=__file__):
 
 def ges_Aonfig(config):
     with open(config, 'r') as stream:
-        return yaml.load(stream)
\ No newline at end of file
+        return yaml.load(stream)
+
+
+def save_valid_mask(path, valid, build_id=''):
+    # 1 bit per row, so the mask of the whole catalogue stays a few MB
+    # build_id: the build_id attr of the data.h5py the rows belong to
+    valid = np.asarray(valid, dtype=np.bool_)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, bits=np.packbits(valid), size=len(valid), build_id=build_id)
+    os.replace(tmp_path, path)
+
+
+def load_valid_mask(path, size=None, build_id=None):
+    # raises ValueError when size or build_id are given and the mask was built for another db
+    data = np.load(path)
+    mask_size = int(data['size'])
+    mask_build_id = str(data['build_id']) if 'build_id' in data else ''
+    if (size is not None and mask_size != size) or (build_id is not None and mask_build_id != build_id):
+        raise ValueError('{} was built for another data.h5py ({} rows, build "{}"), the db has {} rows, build "{}"'.format(
+            path, mask_size, mask_build_id, size, build_id))
+    return np.unpackbits(data['bits'], count=mask_size).astype(np.bool_)
+
+
+def get_build_id(data):
+    # random id written once per fresh make_db build, '' for older dbs
+    return str(data.attrs.get('build_id', ''))
+
+
+def load_image_array(image_path, image_size):
+    # decode once at training resolution: uint8, CHW, RGB
+    from PIL import Image
+    image = Image.open(image_path)
+    image.draft('RGB', (image_size, image_size))  # jpeg reduce-on-decode
+    image = image.convert('RGB').resize((image_size, image_size), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1)
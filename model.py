@@ -1,6 +1,14 @@
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
+
+def group_batch_norm(bn, x, n_groups):
+    '''
+    BatchNorm of x split into n_groups equal, consecutive chunks of the batch: every chunk is normalized with
+    its own statistics and the running statistics are updated once per chunk, in order, exactly as if bn had
+    been called on each chunk separately. The chunks are contiguous views, so only the concatenation copies
+    '''
+    return torch.cat([bn(chunk) for chunk in x.chunk(n_groups)])
+
 
 # NetG - Generator
 class NetG(nn.Module):
@@ -85,6 +93,8 @@ class NetD(nn.Module):
         self.n_t = n_t
         self.m_d = m_d
         self.docvec_size = docvec_size
+        # the input noise is added in eval mode too, inference loaders set this to False for deterministic scores
+        self.eval_noise = True
         # state size: 128 x 128
         self.conv1 = nn.Conv2d(in_channels=3, out_channels=n_f, kernel_size=4, stride=2, padding=1, bias=True)
         self.conv1_bn = nn.BatchNorm2d(n_f)
@@ -117,17 +127,28 @@ class NetD(nn.Module):
 
     def gaussian(self, ins, is_training, mean, stddev):
         if is_training:
-            noise = Variable(ins.data.new(ins.size()).normal_(mean, stddev))
+            noise = ins.new_empty(ins.size()).normal_(mean, stddev)
             return ins + noise
         return ins
 
-    def forward(self, input, skip_v):
-        input = self.gaussian(input, True, 0, 0.1)
-        x = self.LeakyReLU(self.conv1_bn(self.conv1(input)))
-        x = self.LeakyReLU(self.conv2_bn(self.conv2(x)))
-        x = self.LeakyReLU(self.conv3_bn(self.conv3(x)))
-        x = self.LeakyReLU(self.conv4_bn(self.conv4(x)))
-        skip_v = self.gaussian(skip_v, True, 0, 0.1)
+    def batch_norm(self, bn, x, bn_groups):
+        if bn_groups > 1 and self.training:
+            return group_batch_norm(bn, x, bn_groups)
+        return bn(x)
+
+    def forward(self, input, skip_v, logits=False, bn_groups=1):
+        '''
+        logits    : return the pre-sigmoid scores, to be used with BCEWithLogitsLoss (autocast-safe)
+        bn_groups : the batch is bn_groups concatenated batches of equal size. In training mode each one gets
+                    its own BatchNorm statistics, the same as bn_groups separate forward calls
+        '''
+        noise = self.training or self.eval_noise
+        input = self.gaussian(input, noise, 0, 0.1)
+        x = self.LeakyReLU(self.batch_norm(self.conv1_bn, self.conv1(input), bn_groups))
+        x = self.LeakyReLU(self.batch_norm(self.conv2_bn, self.conv2(x), bn_groups))
+        x = self.LeakyReLU(self.batch_norm(self.conv3_bn, self.conv3(x), bn_groups))
+        x = self.LeakyReLU(self.batch_norm(self.conv4_bn, self.conv4(x), bn_groups))
+        skip_v = self.gaussian(skip_v, noise, 0, 0.1)
         emb = self.LeakyReLU(self.fc_emb(skip_v))
         emb = emb.view(emb.size(0), self.n_t, 1, 1) # state size: batch x n_t x 1 x 1
         emb = emb.repeat(1, 1, self.m_d, self.m_d) # state size: batch x n_t x 8 x 8
@@ -135,9 +156,11 @@ class NetD(nn.Module):
         x = self.LeakyReLU(self.conv5(x))
         x = x.view(x.size(0), self.m_d*self.m_d*self.n_f*8)
         x = self.LeakyReLU(self.fc_t(x))
-        s = self.Sigmoid(self.fc_d(x))
-        c = self.Sigmoid(self.fc_c(x))
-        return s,c 
+        s = self.fc_d(x)
+        c = self.fc_c(x)
+        if logits:
+            return s,c
+        return self.Sigmoid(s), self.Sigmoid(c)
 
     def intialize_weights_(self):
         for m in self.modules():
@@ -1,25 +1,299 @@
+import ast
 import gzip
+import json
 import os
 import re
 import tqdm
 import fire
 import time
+import zlib
 import random
+import sqlite3
+import threading
+from array import array
 import numpy as np
-from collections import Counter
+from collections import Counter, OrderedDict
+from multiprocessing import Pool
 import sentencepiece as spm
 from misc import get_logger, ges_Aonfig
+from gensim import matutils
 from gensim.models.doc2vec import Doc2Vec, TaggedDocument
+from gensim.models.doc2vec_inner import train_document_dbow, train_document_dm, train_document_dm_concat
 
 
-def shuffle(ls):
-    random.shuffle(ls)
+def shuffle(ls, rng=random):
+    rng.shuffle(ls)
     return ls
 
 
+def literal_to_product(line):
+    # the metadata dump is one python dict literal per line (eval is unsafe, literal_eval is slow).
+    # python only quotes a string with ' when it holds no quote, so a line without " is json once
+    # ' is swapped for ". anything json rejects (\x escapes, quotes in strings...) goes to literal_eval
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    try:
+        if '"' not in line:
+            return json.loads(line.replace("'", '"'))
+        return json.loads(line)
+    except ValueError:
+        return ast.literal_eval(line)
+
+
+class DocStore:
+    '''
+    Tokenized documents of products.tsv in a compact, memory-mappable form
+    path_tokens.npy  : int32 word-piece indices of all documents, concatenated
+    path_offsets.npy : int64 start of every document in tokens (n_docs + 1)
+    path_keys.npy    : image key (<asin>.jpg) of every document
+    '''
+    names = ['tokens', 'offsets', 'keys']
+
+    def __init__(self, path):
+        self.tokens, self.offsets, self.keys = [np.load('%s_%s.npy' % (path, n), mmap_mode='r') for n in self.names]
+        self.key2row = None
+
+    @classmethod
+    def exists(cls, path):
+        return all(os.path.exists('%s_%s.npy' % (path, n)) for n in cls.names)
+
+    @classmethod
+    def mtime(cls, path):
+        return min(os.path.getmtime('%s_%s.npy' % (path, n)) for n in cls.names)
+
+    @classmethod
+    def save(cls, path, keys, tokens, offsets):
+        arrays = [np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64),
+                  np.array(keys, dtype=np.bytes_)]
+        for n, a in zip(cls.names, arrays):
+            tmp_path = '%s_%s.tmp.npy' % (path, n)
+            np.save(tmp_path, a)
+            os.replace(tmp_path, '%s_%s.npy' % (path, n))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return self.tokens[self.offsets[row]:self.offsets[row + 1]]
+
+    def key(self, row):
+        return self.keys[row].decode('utf-8')
+
+    def find(self, key):
+        # first row of every key, the index is built on the first lookup
+        if self.key2row is None:
+            self.key2row = {}
+            for row, k in enumerate(self.keys.tolist()):
+                self.key2row.setdefault(k, row)
+        return self.key2row.get(key.encode('utf-8'))
+
+
+class TaggedDocs:
+    # re-iterable documents for Doc2Vec, read from the store instead of a list in memory
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __iter__(self):
+        for row in range(len(self.docs)):
+            yield TaggedDocument([str(i) for i in self.docs[row]], [self.docs.key(row)])
+
+
+def infer_vector_seeded(model, doc_words, seed=0):
+    # Doc2Vec.infer_vector seeds its start vector with the builtin hash() (salted per process)
+    # and draws negative samples from model.random, so the same words give a different vector
+    # per process and per call. This is the same inference loop with both seeded from
+    # crc32(words) + seed instead.
+    seed = (zlib.crc32(' '.join(doc_words).encode('utf-8')) + seed) & 0xffffffff
+    model.random = np.random.RandomState(seed)
+    size = model.dv.vector_size
+    once = np.random.Generator(np.random.SFC64(seed))
+    doctag_vectors = ((once.random(size).astype(np.float32) - 0.5) / size).reshape(1, size)
+    doctags_lockf = np.ones(1, dtype=np.float32)
+    doctag_indexes = [0]
+    work = np.zeros(model.layer1_size, dtype=np.float32)
+    neu1 = matutils.zeros_aligned(model.layer1_size, dtype=np.float32)
+
+    alpha = model.alpha
+    alpha_delta = (model.alpha - model.min_alpha) / max(model.epochs - 1, 1)
+    for _ in range(model.epochs):
+        if model.sg:
+            train_document_dbow(model, doc_words, doctag_indexes, alpha, work,
+                                learn_words=False, learn_hidden=False,
+                                doctag_vectors=doctag_vectors, doctags_lockf=doctags_lockf)
+        elif model.dm_concat:
+            train_document_dm_concat(model, doc_words, doctag_indexes, alpha, work, neu1,
+                                     learn_words=False, learn_hidden=False,
+                                     doctag_vectors=doctag_vectors, doctags_lockf=doctags_lockf)
+        else:
+            train_document_dm(model, doc_words, doctag_indexes, alpha, work, neu1,
+                              learn_words=False, learn_hidden=False,
+                              doctag_vectors=doctag_vectors, doctags_lockf=doctags_lockf)
+        alpha -= alpha_delta
+    return doctag_vectors[0]
+
+
+class Text2VecCache:
+    '''
+    Bounded LRU cache of text2vec results keyed by the cleaned title
+    max_size : number of vectors kept in memory
+    path     : optional sqlite file used as a second, unbounded level that survives restarts.
+               it is cleared when it was filled with another model or seed (tag).
+               opened in WAL mode so several processes (make_db workers) can share it
+    commit_every : new vectors are committed to the file in batches of this size, and on flush/close
+    '''
+    def __init__(self, max_size, path=None, tag='', commit_every=1000, timeout=60):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.n_pending = 0
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (tag TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS vecs (text TEXT PRIMARY KEY, vec BLOB)')
+            row = self.db.execute('SELECT tag FROM meta').fetchone()
+            if row is None or row[0] != tag:
+                self.db.execute('DELETE FROM vecs')
+                self.db.execute('DELETE FROM meta')
+                self.db.execute('INSERT INTO meta VALUES (?)', (tag,))
+            self.db.commit()
+
+    def get(self, text):
+        with self.lock:
+            vector = self.memory.get(text)
+            if vector is not None:
+                self.memory.move_to_end(text)
+                self.hits += 1
+                return vector
+            if self.db is not None:
+                row = self.db.execute('SELECT vec FROM vecs WHERE text = ?', (text,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    vector = np.frombuffer(row[0], dtype=np.float32)
+                    self.put_memory(text, vector)
+                    return vector
+            self.misses += 1
+            return None
+
+    def put(self, text, vector):
+        with self.lock:
+            self.put_memory(text, vector)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO vecs VALUES (?, ?)',
+                                (text, np.asarray(vector, dtype=np.float32).tobytes()))
+                self.n_pending += 1
+                if self.n_pending >= self.commit_every:
+                    self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.n_pending = 0
+
+    def flush(self):
+        with self.lock:
+            if self.db is not None and self.n_pending:
+                self.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def put_memory(self, text, vector):
+        self.memory[text] = vector
+        self.memory.move_to_end(text)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def info(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'size': len(self.memory), 'max_size': self.max_size}
+
+
+_count_sp = None
+
+
+def init_count_worker(spm_model_path):
+    global _count_sp
+    _count_sp = spm.SentencePieceProcessor()
+    _count_sp.Load(spm_model_path)
+
+
+def read_line_range(path, start, end):
+    # lines that start in [start, end)
+    with open(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf-8')
+
+
+def count_wps(args, batch_size=10000):
+    path, start, end = args
+    wp_counter = Counter()
+    max_wps_len = 0
+
+    def count(lines):
+        nonlocal max_wps_len
+        for wps in _count_sp.EncodeAsPieces(lines):
+            wp_counter.update(wps)
+            # pieces of one word: a word starts at every piece beginning with the spm space mark
+            n = 0
+            for wp in wps:
+                if wp.startswith('\u2581') and n:
+                    max_wps_len = max(max_wps_len, n)
+                    n = 0
+                n += 1
+            max_wps_len = max(max_wps_len, n)
+
+    lines = []
+    for line in read_line_range(path, start, end):
+        lines.append(' '.join(line.strip().split()))
+        if len(lines) == batch_size:
+            count(lines)
+            lines = []
+    if lines:
+        count(lines)
+    return wp_counter, max_wps_len
+
+
+_parse_worker = None
+
+
+def init_parse_worker(config):
+    global _parse_worker
+    _parse_worker = EcommerceDataParser(config)
+
+
+def parse_lines(args):
+    start, lines = args
+    rng = random.Random(start)
+    rows = []
+    for i, l in enumerate(lines, start):
+        product = literal_to_product(l)
+        row = _parse_worker.parse_product(product, rng)
+        if row is not None:
+            rows.append((i, row, {'title': product['title'], 'categories': product['categories']}))
+    return rows
+
+
 class EcommerceDataParser:
     def __init__(self, config, use=False):
         self.logger = get_logger()
+        self.config = config
         self.meta_path = config['META_PATH']
         self.titles_path = config['TITLES_PATH']
         self.spm_dir_path = config['SPM_DIR_PATH']
@@ -39,6 +313,11 @@ class EcommerceDataParser:
         self.doc2vec_epochs = config['DOC2CEC_EPOCHS']
         self.n_workers = config['N_WORKERS']
         self.window_size = config['WINDOW_SIZE']
+        self.infer_seed = config.get('INFER_SEED', 0)
+        self.text2vec_cache_size = config.get('TEXT2VEC_CACHE_SIZE', 0)
+        self.text2vec_cache_path = config.get('TEXT2VEC_CACHE_PATH', '')
+        self.vec_cache = None
+        self.infer_lock = threading.Lock()
 
         self.re_sc = re.compile('[\!@#$%\^&\*\(\)=\[\]\{\}\.,/\?~\+\"|\_\-:;]')
         self.stopwords =['&amp;', '&quot;']
@@ -54,6 +333,9 @@ class EcommerceDataParser:
         self.sp.Load(spm_model_path)
         self.i2wp = [line.split('\t')[0] for line in open(self.spm_wp_path)]
         self.wp2i = dict([(v, i) for i, v in enumerate(self.i2wp)])
+        # spm.vocab is ordered by frequency, not by spm id: spm id -> wp2i index (-1: not in vocab)
+        self.sp2wp = np.array([self.wp2i.get(self.sp.IdToPiece(i), -1) for i in range(self.sp.GetPieceSize())],
+                              dtype=np.int32)
         self.logger.info('USE MODE LOAD SPM DONE: %d sec' % (time.time() - st))
 
     def preprocess(self):
@@ -86,115 +368,133 @@ class EcommerceDataParser:
         text = self.re_sc.sub(' ', text).strip()
         return ' '.join(text.split()).lower()
 
-    def write_titles(self, titles):
-        titles_dir = os.path.dirname(self.titles_path)
-        os.makedirs(titles_dir, exist_ok=True)
-
-        f_titles = open(self.titles_path, 'w')
-
-        for title in tqdm.tqdm(titles, mininterval=1):
-            f_titles.write(title + '\n')
+    def parse_product(self, product, rng=random):
+        for col in self.use_cols:
+            if col not in product:
+                return None
 
-    def parse_data(self):
-        data_list = []
-        category_list = []
-        titles = ['text']
-        g = gzip.open(self.meta_path, 'r')
-        for i, l in enumerate(g):
-            product = eval(l)
-            n_read = int(self.n_log_print) * 10
-            if i % n_read == 0:
-                self.logger.info("Read %d lines..." % i)
+        asin = product['asin']
+        url = product['imUrl']
+        brand = product['brand'] if 'brand' in product else ''
+        catenames = ' '.join(list(map(lambda x: ' '.join(x[-1:]), product['categories'])))
 
-            skip_flag = False
+        raw_categories = product['categories'][0] if len(product['categories']) > 0 else None
 
-            for col in self.use_cols:
-                if col not in product.keys():
-                    skip_flag = True
+        if raw_categories is None:
+            return None
 
-            if skip_flag:
-                continue
+        if len(self.use_cate) > 0 and raw_categories[0] not in self.use_cate:
+            return None
 
-            asin = product['asin']
-            url = product['imUrl']
-            brand = product['brand'] if 'brand' in product.keys() else ''
-            catenames = ' '.join(list(map(lambda x: ' '.join(x[-1:]), product['categories'])))
+        raw_categories = list(map(lambda x: x.replace('>', '').replace(' ', '').strip(),
+                                  raw_categories[:self.cate_depth]))
+        category = '>'.join(raw_categories)
 
-            raw_categories = product['categories'][0] if len(product['categories']) > 0 else None
+        # hardcoding erase cate
+        chose_flag = False
 
-            if raw_categories is None:
-                continue
+        cates = category.split('>')
+        cates = cates[1] if len(cates) > 2 else None
+        if cates is not None and 'Guitars' in cates:
+            chose_flag = True
 
-            if len(self.use_cate) > 0 and raw_categories[0] not in self.use_cate:
-                continue
-
-            raw_categories = list(map(lambda x: x.replace('>', '').replace(' ', '').strip(),
-                                      raw_categories[:self.cate_depth]))
-            category = '>'.join(raw_categories)
-
-            # hardcoding erase cate
+        if 'BeginnerKits' in category:
             chose_flag = False
 
-            cates = category.split('>')
-            cates = cates[1] if len(cates) > 2 else None
-            if cates is not None and 'Guitars' in cates:
-                chose_flag = True
-
-            if 'BeginnerKits' in category:
-                chose_flag = False
-
-            select_cates = [
-                #  "Clothing,Shoes&Jewelry>adidas"
-                # , "Home&Kitchen>Furniture>LivingRoomFurniture>Tables"
-                # , "Clothing,Shoes&Jewelry>Women>Clothing>Coats&Jackets"
-                # , "Beauty>Makeup>Lips>Lipstick"
-                # , "Clothing,Shoes&Jewelry>Women>Shoes>Boots"
-                # , "Clothing,Shoes&Jewelry>Girls>Clothing>Dresses"
-                # "Clothing,Shoes&Jewelry>Women>Accessories>Hats&Caps"
-                # , "Clothing,Shoes&Jewelry>Women>Clothing>Skirts"
-                # , "Clothing,Shoes&Jewelry>Women>Handbags&Wallets>ShoulderBags"
-                #, "Automotive>Motorcycle&Powersports>ProtectiveGear>Helmets"
-                #, "Clothing,Shoes&Jewelry>N>Nike"
-                #, "Tools&HomeImprovement>Lighting&CeilingFans>Lamps&Shades>TableLamps"
-            ]
-            if category in select_cates:
-                chose_flag = True
-
-            if not chose_flag:
-                continue
-
-            title = self.text_cleaning(' '.join(shuffle([catenames, brand, product['title']])))
-            if len(title) == 0:
-                continue
-
-            shuffle_titles = set()
-            shuffle_titles.add(title)
-            for _ in range(self.n_shuffle):
-                shuffle_titles.add(self.text_cleaning(' '.join(shuffle([product['title']])))) # add catenames and brand
-
-            shuffle_titles = list(shuffle_titles)
-            titles += shuffle_titles
-            for title in shuffle_titles:
-                data_list.append((asin, category, title, url))
-
-            if category not in category_list:
-                category_list.append(category)
-
-            if len(data_list) % self.n_log_print == 0:
-                self.logger.info("%s\t%s\t%s %s -> %s [%s]" % (i, asin, product['title'], product['categories'], title, category))
-
-            if i > self.n_sample:
-                break
-
-        self.write_titles(titles)
+        select_cates = [
+            #  "Clothing,Shoes&Jewelry>adidas"
+            # , "Home&Kitchen>Furniture>LivingRoomFurniture>Tables"
+            # , "Clothing,Shoes&Jewelry>Women>Clothing>Coats&Jackets"
+            # , "Beauty>Makeup>Lips>Lipstick"
+            # , "Clothing,Shoes&Jewelry>Women>Shoes>Boots"
+            # , "Clothing,Shoes&Jewelry>Girls>Clothing>Dresses"
+            # "Clothing,Shoes&Jewelry>Women>Accessories>Hats&Caps"
+            # , "Clothing,Shoes&Jewelry>Women>Clothing>Skirts"
+            # , "Clothing,Shoes&Jewelry>Women>Handbags&Wallets>ShoulderBags"
+            #, "Automotive>Motorcycle&Powersports>ProtectiveGear>Helmets"
+            #, "Clothing,Shoes&Jewelry>N>Nike"
+            #, "Tools&HomeImprovement>Lighting&CeilingFans>Lamps&Shades>TableLamps"
+        ]
+        if category in select_cates:
+            chose_flag = True
+
+        if not chose_flag:
+            return None
+
+        title = self.text_cleaning(' '.join(shuffle([catenames, brand, product['title']], rng)))
+        if len(title) == 0:
+            return None
+
+        shuffle_titles = [title]
+        for _ in range(self.n_shuffle):
+            shuffle_titles.append(self.text_cleaning(' '.join(shuffle([product['title']], rng)))) # add catenames and brand
+
+        # unique titles, in a stable order
+        shuffle_titles = list(dict.fromkeys(shuffle_titles))
+        return asin, category, shuffle_titles, url
+
+    def read_meta_batches(self, batch_size):
+        # gzip is decompressed here, the (slow) literal parsing happens in the workers
+        n_read = int(self.n_log_print) * 10
+        with gzip.open(self.meta_path, 'r') as g:
+            batch = []
+            start = 0
+            for i, l in enumerate(g):
+                if i % n_read == 0:
+                    self.logger.info("Read %d lines..." % i)
+                batch.append(l)
+                if len(batch) == batch_size:
+                    yield start, batch
+                    start = i + 1
+                    batch = []
+            if batch:
+                yield start, batch
+
+    def parse_data(self, batch_size=10000):
+        """
+        Parses the gzipped metadata in batches of lines on N_WORKERS processes and streams
+        the selected products to products.tsv, titles.txt and category.txt in input order.
+        The title shuffling is seeded by the batch offset, so the outputs do not depend on
+        the number of workers.
+        """
+        titles_dir = os.path.dirname(self.titles_path)
+        os.makedirs(titles_dir, exist_ok=True)
 
-        with open(self.parse_data_path, 'w') as data_file:
-            for data in data_list:
-                output = "{}\t{}\t{}\t{}\n".format(data[0], data[1], data[2], data[3])
-                data_file.write(output)
+        category_dict = {}
+        n_data = 0
+        if self.n_workers > 1:
+            pool = Pool(self.n_workers, initializer=init_parse_worker, initargs=(self.config,))
+            imap = pool.imap
+        else:
+            pool = None
+            init_parse_worker(self.config)
+            imap = map
+        with open(self.titles_path, 'w') as f_titles, open(self.parse_data_path, 'w') as data_file:
+            f_titles.write('text\n')
+            done = False
+            for rows in imap(parse_lines, self.read_meta_batches(batch_size)):
+                for i, (asin, category, shuffle_titles, url), product in rows:
+                    for title in shuffle_titles:
+                        f_titles.write(title + '\n')
+                        data_file.write("{}\t{}\t{}\t{}\n".format(asin, category, title, url))
+                        n_data += 1
+
+                        if n_data % self.n_log_print == 0:
+                            self.logger.info("%s\t%s\t%s %s -> %s [%s]" % (i, asin, product['title'], product['categories'], title, category))
+
+                    category_dict.setdefault(category, len(category_dict))
+
+                    if i > self.n_sample:
+                        done = True
+                        break
+                if done:
+                    break
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
         with open(self.category_path, 'w') as data_file:
-            for category in category_list:
+            for category in category_dict:
                 output = "{}\n".format(category)
                 data_file.write(output)
 
@@ -214,34 +514,31 @@ class EcommerceDataParser:
             for v, c in vocab:
                 fp.write(f'{v}\t{c}\n')
 
-    def build_x_vocab(self, txt_path, spm_dir_path, wp_vocab_path):
+    def build_x_vocab(self, txt_path, spm_dir_path, wp_vocab_path, range_size=64 * 1024 * 1024):
+        """
+        Counts the word pieces of titles.txt over byte ranges on N_WORKERS processes.
+        Counters are merged in file order, so ties in most_common() and the written
+        spm.vocab are the same as counting the file line by line.
+        """
         spm_model_path = os.path.join(spm_dir_path, 'spm.model')
-        sp = spm.SentencePieceProcessor()
-        sp.Load(spm_model_path)
+        size = os.path.getsize(txt_path)
+        n_ranges = max(self.n_workers, (size + range_size - 1) // range_size, 1)
+        bounds = [size * i // n_ranges for i in range(n_ranges + 1)]
+        ranges = [(txt_path, bounds[i], bounds[i + 1]) for i in range(n_ranges)]
 
         wp_counter = Counter()
-        title_lines = open(txt_path).readlines()
-
         max_wps_len = 0
-        max_words_len = 0
-        for line in tqdm.tqdm(title_lines, mininterval=1):
-            line = line.strip()
-            words = line.split()
-            max_words_len = max(max_words_len, len(words))
-
-            wps = []
-            for w in words:
-                wp = sp.EncodeAsPieces(w)
-                max_wps_len = max(len(wp), max_wps_len)
-                wps += wp
-
-            for wp in wps:
-                wp_counter[wp] += 1
+        pool = Pool(self.n_workers, initializer=init_count_worker, initargs=(spm_model_path,))
+        for counter, wps_len in tqdm.tqdm(pool.imap(count_wps, ranges), total=n_ranges, mininterval=1):
+            wp_counter.update(counter)
+            max_wps_len = max(max_wps_len, wps_len)
+        pool.close()
+        pool.join()
 
         wp_vocab = [('PAD', max_wps_len)] + wp_counter.most_common()
         self.write_vocab(wp_vocab, wp_vocab_path)
 
-    def text2wp(self, text):
+    def text2wp_slow(self, text):
         words = text.split()
         wp_sent = []
         for i, word in enumerate(words):
@@ -251,22 +548,86 @@ class EcommerceDataParser:
 
         return wp_sent
 
-    def get_doc_list(self):
-        self.document_list = []
+    def text2wp(self, text):
+        return self.text2wp_batch([text])[0].tolist()
+
+    def text2wp_batch(self, texts, padded=False):
+        """
+        Word-piece indices of many titles with one SentencePiece call.
+        Returns a list of int32 arrays, or with padded=True an (n, max_len) int32 array
+        filled with the PAD index 0 and the lengths.
+        """
+        if not texts:
+            return (np.zeros((0, 0), dtype=np.int32), np.zeros(0, dtype=np.int64)) if padded else []
+        texts = [' '.join(text.split()) for text in texts]
+        ids = self.sp.EncodeAsIds(texts)
+        lens = np.fromiter((len(i) for i in ids), dtype=np.int64, count=len(ids))
+        flat = np.fromiter((i for sent in ids for i in sent), dtype=np.int32, count=int(lens.sum()))
+        wps = self.sp2wp[flat]
+        keep = wps >= 0
+        # keep counts per text -> split points of the kept indices
+        row = np.repeat(np.arange(len(texts)), lens)
+        kept_lens = np.bincount(row[keep], minlength=len(texts))
+        wp_sents = np.split(wps[keep], np.cumsum(kept_lens)[:-1])
+
+        # unknown pieces: encoding word by word keeps their surface form, which may be in spm.vocab
+        unk_rows = np.unique(row[flat == self.sp.unk_id()])
+        for r in unk_rows:
+            wp_sents[r] = np.asarray(self.text2wp_slow(texts[r]), dtype=np.int32)
+
+        if not padded:
+            return wp_sents
+        lengths = np.array([len(w) for w in wp_sents], dtype=np.int64)
+        out = np.zeros((len(texts), lengths.max() if len(texts) else 0), dtype=np.int32)
+        for r, w in enumerate(wp_sents):
+            out[r, :len(w)] = w
+        return out, lengths
+
+    def doc_store_path(self):
+        return os.path.join(self.doc2vec_dir_path, 'docs')
+
+    def build_doc_store(self, batch_size=10000):
+        keys = []
+        tokens = array('i')
+        offsets = array('q', [0])
+
+        def add_batch(batch_keys, batch_titles):
+            for key, wp_i in zip(batch_keys, self.text2wp_batch(batch_titles)):
+                keys.append(key)
+                tokens.frombytes(wp_i.astype(np.int32).tobytes())
+                offsets.append(len(tokens))
+
         with open(self.parse_data_path, 'r') as data_file:
             st = time.time()
+            batch_keys, batch_titles = [], []
             for index, data in enumerate(data_file):
                 data = data.split('\t')
                 key = data[0] + '.jpg'
                 cate = data[1]
                 title = data[2]
-                wp_i = self.text2wp(title)
-                i_wp = [self.i2wp[i] for i in wp_i]
                 if index % self.n_log_print == 0:
+                    wp_i = self.text2wp(title)
+                    i_wp = [self.i2wp[i] for i in wp_i]
                     self.logger.info("%s %s %s %d sec" % (title, i_wp, wp_i, time.time() - st))
                     st = time.time()
-                wp_i_str = list(map(lambda x: str(x), wp_i))
-                self.document_list.append((key, wp_i_str))
+                batch_keys.append(key)
+                batch_titles.append(title)
+                if len(batch_titles) == batch_size:
+                    add_batch(batch_keys, batch_titles)
+                    batch_keys, batch_titles = [], []
+            if batch_titles:
+                add_batch(batch_keys, batch_titles)
+        DocStore.save(self.doc_store_path(), keys, tokens, offsets)
+
+    @property
+    def docs(self):
+        # tokenized products.tsv, built once and memory-mapped on first use
+        if getattr(self, '_docs', None) is None:
+            path = self.doc_store_path()
+            if not DocStore.exists(path) or DocStore.mtime(path) < os.path.getmtime(self.parse_data_path):
+                self.build_doc_store()
+            self._docs = DocStore(path)
+        return self._docs
 
     def train_doc2vec(self):
         import logging
@@ -275,9 +636,11 @@ class EcommerceDataParser:
             level=logging.INFO)
 
         doc2vec_model_path = os.path.join(self.doc2vec_dir_path, 'doc2vec.model')
+        os.makedirs(self.doc2vec_dir_path, exist_ok=True)
 
-        self.get_doc_list()
-        documents = [TaggedDocument(doc, [key]) for key, doc in self.document_list]
+        self._docs = None
+        self.build_doc_store()
+        documents = TaggedDocs(self.docs)
         self.model = Doc2Vec(documents, vector_size=self.doc_vec_size,
                         window=self.window_size,
                         min_count=1,
@@ -287,19 +650,23 @@ class EcommerceDataParser:
 
         self.model.save(doc2vec_model_path)
 
-    def load_doc2vec_model(self):
+    def load_doc2vec_model(self, mmap=None):
+        # the document store (only needed for search_doc) is opened lazily, see docs
+        # mmap='r' maps the large arrays read-only so forked workers share them
         st = time.time()
         self.logger.info('USE MODE LOAD DOC2VEC')
         doc2vec_model_path = os.path.join(self.doc2vec_dir_path, 'doc2vec.model')
-        self.get_doc_list()
-        self.model = Doc2Vec.load(doc2vec_model_path)
+        self.model = Doc2Vec.load(doc2vec_model_path, mmap=mmap)
+        if self.text2vec_cache_size > 0:
+            tag = '%s:%s:%d' % (doc2vec_model_path, os.path.getmtime(doc2vec_model_path), self.infer_seed)
+            self.vec_cache = Text2VecCache(self.text2vec_cache_size, self.text2vec_cache_path, tag)
         self.logger.info('USE MODE LOAD DOC2VEC DONE: %d sec' % (time.time() - st))
 
     def search_doc(self, q_key):
-        for key, doc  in self.document_list:
-            if key == q_key:
-                return [self.i2wp[int(i)] for i in doc]
-        return ['NO_SEARCH_RESULT']
+        row = self.docs.find(q_key)
+        if row is None:
+            return ['NO_SEARCH_RESULT']
+        return [self.i2wp[i] for i in self.docs[row]]
 
     def query_doc2vec_topn(self, q):
         if type(q) == str:
@@ -307,7 +674,7 @@ class EcommerceDataParser:
 
         q = np.asarray(q).astype(str)
 
-        vector = self.model.infer_vector(q)
+        vector = infer_vector_seeded(self.model, q.tolist(), self.infer_seed)
         sims = self.model.docvecs.most_similar([vector])
 
         print(''.join([self.i2wp[int(i)] for i in q]))
@@ -318,11 +685,52 @@ class EcommerceDataParser:
         print()
 
     def text2vec(self, text):
-        wps = self.text2wp(text)
+        # inference is seeded (INFER_SEED), so a cached vector equals a freshly inferred one
+        text = self.text_cleaning(text)
+        if self.vec_cache is not None:
+            vector = self.vec_cache.get(text)
+            if vector is not None:
+                return vector.copy()
+
+        return self.infer_wps(text, self.text2wp(text))
+
+    def text2vec_batch(self, texts):
+        # one tokenizer call for the cache misses, inference stays per text
+        texts = [self.text_cleaning(text) for text in texts]
+        vectors = [None] * len(texts)
+        if self.vec_cache is not None:
+            for i, text in enumerate(texts):
+                vector = self.vec_cache.get(text)
+                if vector is not None:
+                    vectors[i] = vector.copy()
+        misses = [i for i, v in enumerate(vectors) if v is None]
+        if misses:
+            for i, wps in zip(misses, self.text2wp_batch([texts[i] for i in misses])):
+                vectors[i] = self.infer_wps(texts[i], wps)
+        return vectors
+
+    def infer_wps(self, text, wps):
         wps_str = list(map(lambda x: str(x), wps))
-        vector = self.model.infer_vector(wps_str)
+        with self.infer_lock:
+            vector = infer_vector_seeded(self.model, wps_str, self.infer_seed)
+
+        if self.vec_cache is not None:
+            self.vec_cache.put(text, vector.copy())
         return vector
 
+    def text2vec_cache_info(self):
+        if self.vec_cache is None:
+            return None
+        return self.vec_cache.info()
+
+    def flush_text2vec_cache(self):
+        if self.vec_cache is not None:
+            self.vec_cache.flush()
+
+    def close_text2vec_cache(self):
+        if self.vec_cache is not None:
+            self.vec_cache.close()
+
 
 def main(config_path):
     config = ges_Aonfig(config_path)['PARSEMETA']
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+
+import fire
+import h5py
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from misc import get_logger, ges_Aonfig
+from export import FoldedNetD, describe, sidecar_path
+from screen_abuse import load_discriminator, db_products, product_id, ProductImages
+
+
+def load_dev_sample(data_path, image_dir, rows, image_size, batch_size=64, n_workers=0):
+    '''
+    (images, docvecs, cates) of the given dev rows that have a decodable image, as lists of batches.
+    images are float in [0, 1] like the input of screen_abuse.py
+    '''
+    rows = np.sort(rows)
+    with h5py.File(data_path, 'r') as data:
+        asins = [product_id(a) for a in data['dev']['asin'][rows]]
+        docvecs = torch.from_numpy(data['dev']['docvec'][rows].astype(np.float32))
+        cates = data['dev']['cate'][rows]
+    if cates.ndim == 2:
+        cates = cates.argmax(1)
+    cates = torch.from_numpy(cates.astype(np.int64))
+    loader = DataLoader(ProductImages(image_dir, asins, image_size), batch_size=batch_size, num_workers=n_workers)
+    batches, start = [], 0
+    for image, ok in loader:
+        end = start + len(ok)
+        batches.append((image[ok].float().div_(255), docvecs[start:end][ok], cates[start:end][ok]))
+        start = end
+    return [b for b in batches if len(b[0])]
+
+
+def quantize_discriminator(netD, batches, backend='fbgemm'):
+    '''
+    Post-training static int8 quantization (FX graph mode) of NetD in eval mode: BatchNorm folded into the
+    convs (FoldedNetD), activation ranges observed on the calibration batches, weights per channel.
+    The final sigmoids stay in float so the scores keep their full resolution
+    '''
+    torch.backends.quantized.engine = backend
+    folded = FoldedNetD(netD).eval()
+    qconfig_mapping = get_default_qconfig_mapping(backend).set_object_type(nn.Sigmoid, None)
+    prepared = prepare_fx(folded, qconfig_mapping, example_inputs=batches[0][:2])
+    with torch.inference_mode():
+        for image, docvec, _ in batches:
+            prepared(image, docvec)
+    return convert_fx(prepared)
+
+
+def compare(netD, quantized, batches):
+    # real/fake and class scores of the quantized model against fp32 on the same images
+    real, real_q, cls, cls_q, cates = [], [], [], [], []
+    with torch.inference_mode():
+        for image, docvec, cate in batches:
+            s, c = netD(image, docvec)
+            s_q, c_q = quantized(image, docvec)
+            real.append(s.view(-1))
+            real_q.append(s_q.view(-1))
+            cls.append(c)
+            cls_q.append(c_q)
+            cates.append(cate)
+    real, real_q, cls, cls_q, cates = [torch.cat(x) for x in (real, real_q, cls, cls_q, cates)]
+    return {'n_images': len(real),
+            'real_mean_abs_diff': float((real - real_q).abs().mean()),
+            'real_max_abs_diff': float((real - real_q).abs().max()),
+            'real_decision_agreement': float(((real > 0.5) == (real_q > 0.5)).float().mean()),
+            'cls_mean_abs_diff': float((cls - cls_q).abs().mean()),
+            'cls_max_abs_diff': float((cls - cls_q).abs().max()),
+            'pred_agreement': float((cls.argmax(1) == cls_q.argmax(1)).float().mean()),
+            'cls_accuracy_fp32': float((cls.argmax(1) == cates).float().mean()),
+            'cls_accuracy_int8': float((cls_q.argmax(1) == cates).float().mean())}
+
+
+def images_per_sec(model, image, docvec, n_iter=10, n_warmup=2):
+    with torch.inference_mode():
+        for _ in range(n_warmup):
+            model(image, docvec)
+        st = time.perf_counter()
+        for _ in range(n_iter):
+            model(image, docvec)
+    return n_iter * len(image) / (time.perf_counter() - st)
+
+
+def quantize(servertype, checkpoint, out_dir='exports', name='netD_int8', n_calib=1024, n_eval=1024,
+             batch_size=64, backend='fbgemm', seed=0, n_workers=None, threads=None):
+    """
+    INT8 NetD for cpu scoring, calibrated on a random sample of the dev split of data.h5py.
+    python quantize.py quantize <servertype> <netD checkpoint> [--n-calib 1024] [--n-eval 1024] [--backend fbgemm]
+    Writes <out_dir>/<name>.pt (TorchScript) and <name>.json with the accuracy report against fp32 on
+    n_eval other dev rows and the cpu throughput of both. The .pt can be passed to screen_abuse.py as the
+    checkpoint. Use --backend qnnpack on ARM.
+    """
+    logger = get_logger()
+    if threads:
+        torch.set_num_threads(threads)
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError('backend {} is not supported here: {}'.format(backend, torch.backends.quantized.supported_engines))
+    config = ges_Aonfig('./configs/config-{}.yaml'.format(servertype))['MAKEDB']
+    data_path = os.path.join(config['TRAIN_DIR_PATH'], 'data.h5py')
+    n_workers = config['N_WORKERS'] if n_workers is None else n_workers
+
+    netD = load_discriminator(checkpoint)
+    rows = db_products(data_path, ['dev'])['row']
+    rows = np.random.RandomState(seed).permutation(rows)
+    if n_calib < 1 or n_eval < 1 or len(rows) < n_calib + n_eval:
+        raise ValueError('the dev split of {} has {} products, {} calibration + {} evaluation requested'.format(
+            data_path, len(rows), n_calib, n_eval))
+    calib = load_dev_sample(data_path, config['IMAGE_DIR_PATH'], rows[:n_calib], netD.m_d * 16, batch_size, n_workers)
+    evals = load_dev_sample(data_path, config['IMAGE_DIR_PATH'], rows[n_calib:n_calib + n_eval], netD.m_d * 16,
+                            batch_size, n_workers)
+    if not calib or not evals:
+        raise ValueError('no decodable images in {} for the {} calibration / {} evaluation dev products'.format(
+            config['IMAGE_DIR_PATH'], n_calib, n_eval))
+
+    st = time.time()
+    # the report measures the TorchScript module that is saved and loaded by screen_abuse.py
+    quantized = torch.jit.script(quantize_discriminator(netD, calib, backend))
+    logger.info('calibrated on %d images (%.1f sec)' % (sum(len(b[0]) for b in calib), time.time() - st))
+
+    report = compare(netD, quantized, evals)
+    image, docvec = torch.cat([b[0] for b in evals])[:batch_size], torch.cat([b[1] for b in evals])[:batch_size]
+    fp32_ips, int8_ips = images_per_sec(netD, image, docvec), images_per_sec(quantized, image, docvec)
+    report.update(fp32_images_per_sec=fp32_ips, int8_images_per_sec=int8_ips, speedup=int8_ips / fp32_ips,
+                  threads=torch.get_num_threads(), batch_size=len(image))
+    for k, v in report.items():
+        logger.info('%s: %s' % (k, v))
+
+    os.makedirs(out_dir, exist_ok=True)
+    script_path = os.path.join(out_dir, name + '.pt')
+    torch.jit.save(quantized, script_path)
+    meta = describe('netD', netD)
+    meta.update(checkpoint=os.path.abspath(checkpoint), torch_version=torch.__version__,
+                files={'torchscript': os.path.basename(script_path)},
+                quantization={'dtype': 'int8', 'backend': backend, 'mode': 'static', 'n_calib': n_calib,
+                              'seed': seed, 'float_ops': ['sigmoid']},
+                accuracy=report)
+    with open(sidecar_path(script_path), 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info('%s -> %s (%.2fx images/sec)' % (checkpoint, script_path, report['speedup']))
+
+
+if __name__ == '__main__':
+    fire.Fire({'quantize': quantize})
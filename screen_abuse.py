@@ -0,0 +1,312 @@
+import os
+import json
+import time
+
+import fire
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from model import NetD
+from misc import get_logger, ges_Aonfig, load_image_array
+
+
+SOURCES = ['db', 'tsv']
+SPLITS = ['train', 'dev']
+
+
+def load_discriminator(checkpoint_path, device='cpu'):
+    '''
+    NetD in eval mode: BatchNorm with running statistics and no input noise, so a score does not depend on
+    the rest of its batch. checkpoint_path : netD state dict (netd_checkpoints/*.pth) or a full training
+    checkpoint (checkpoints/*.pth). The sizes are read from the weights.
+    A model written by export.py or quantize.py (.pt next to its .json sidecar) is loaded as it is.
+    '''
+    if os.path.exists(os.path.splitext(checkpoint_path)[0] + '.json'):
+        from export import load_exported
+        netD = load_exported(checkpoint_path, device)
+        if netD.meta['model'] != 'netD':
+            raise ValueError('{} is an exported {}, not netD'.format(checkpoint_path, netD.meta['model']))
+        return netD
+    state = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    if 'netD' in state:
+        state = state['netD']
+    n_f = state['conv1.weight'].shape[0]
+    n_t, docvec_size = state['fc_emb.weight'].shape
+    n_cls = state['fc_c.weight'].shape[0]
+    m_d = int(round((state['fc_t.weight'].shape[1] // (n_f * 8)) ** 0.5))
+    netD = NetD(n_cls=n_cls, n_t=n_t, n_f=n_f, docvec_size=docvec_size, m_d=m_d)
+    netD.load_state_dict(state)
+    netD.eval_noise = False
+    return netD.to(device).eval()
+
+
+def product_id(asin):
+    # the db stores the image file name (<asin>.jpg)
+    asin = asin.decode('utf-8') if isinstance(asin, bytes) else asin
+    return asin[:-4] if asin.endswith('.jpg') else asin
+
+
+def db_products(data_path, splits):
+    '''
+    First row of every product in the given splits of data.h5py (a product has N_SHUFFLE rows with shuffled
+    titles, in both splits). -> dict of asin, cate, split (index into SPLITS), row, ordered by split and row
+    '''
+    columns = {'asin': [], 'cate': [], 'split': [], 'row': []}
+    seen = set()
+    with h5py.File(data_path, 'r') as data:
+        for split in splits:
+            asins = data[split]['asin'][:]
+            cates = data[split]['cate'][:]
+            if cates.ndim == 2:
+                cates = cates.argmax(1)
+            for row, asin in enumerate(asins):
+                if asin in seen:
+                    continue
+                seen.add(asin)
+                columns['asin'].append(product_id(asin))
+                columns['cate'].append(cates[row])
+                columns['split'].append(SPLITS.index(split))
+                columns['row'].append(row)
+    return {k: np.array(v, dtype=object if k == 'asin' else np.int64) for k, v in columns.items()}
+
+
+def tsv_products(parse_data_path, category_path, data_path=None):
+    '''
+    First line of every product of products.tsv. The docvec stored in data.h5py is reused where the product
+    is in the db (row >= 0), the others keep their title to be vectorized. -> dict as db_products plus title
+    '''
+    with open(category_path) as f:
+        target2idx = {t.strip('\n'): i for i, t in enumerate(f)}
+    index = {}
+    if data_path is not None and os.path.exists(data_path):
+        db = db_products(data_path, SPLITS)
+        index = {asin: (split, row) for asin, split, row in zip(db['asin'], db['split'], db['row'])}
+
+    columns = {'asin': [], 'cate': [], 'split': [], 'row': [], 'title': []}
+    seen = set()
+    with open(parse_data_path) as f:
+        for line in f:
+            row = line.rstrip('\n').split('\t')
+            asin = row[0]
+            if asin in seen:
+                continue
+            seen.add(asin)
+            split, db_row = index.get(asin, (-1, -1))
+            columns['asin'].append(asin)
+            columns['cate'].append(target2idx.get(row[1], -1))
+            columns['split'].append(split)
+            columns['row'].append(db_row)
+            columns['title'].append(row[2])
+    return {k: np.array(v, dtype=object if k in ('asin', 'title') else np.int64) for k, v in columns.items()}
+
+
+class ProductImages(Dataset):
+    '''
+    Decodes <image_dir>/<asin>.jpg at the NetD input size. Returns (uint8 3 x size x size, ok), where a
+    missing or broken image gives zeros and ok False instead of failing the batch.
+    '''
+    def __init__(self, image_dir, asins, image_size=128):
+        self.image_dir = image_dir
+        self.asins = asins
+        self.image_size = image_size
+
+    def __len__(self):
+        return len(self.asins)
+
+    def __getitem__(self, index):
+        try:
+            image = load_image_array(os.path.join(self.image_dir, self.asins[index] + '.jpg'), self.image_size)
+            return torch.from_numpy(np.ascontiguousarray(image)), True
+        except Exception:
+            return torch.zeros(3, self.image_size, self.image_size, dtype=torch.uint8), False
+
+
+class DocvecReader():
+    '''
+    Docvecs of a batch of products: slices of the stored docvec columns of data.h5py, read as one contiguous
+    range per split (the products are ordered by row), and the text encoder only for products not in the db.
+    '''
+    def __init__(self, data_path, docvec_size, parser_fn=None):
+        self.data = h5py.File(data_path, 'r') if data_path is not None and os.path.exists(data_path) else None
+        self.docvec_size = docvec_size
+        self.parser_fn = parser_fn
+        self.parser = None
+        self.n_inferred = 0
+
+    def read(self, splits, rows, titles=None):
+        vecs = np.zeros((len(rows), self.docvec_size), dtype=np.float32)
+        for i, split in enumerate(SPLITS):
+            idx = np.flatnonzero(splits == i)
+            if len(idx) == 0:
+                continue
+            lo, hi = rows[idx].min(), rows[idx].max() + 1
+            vecs[idx] = self.data[split]['docvec'][lo:hi][rows[idx] - lo]
+        missing = np.flatnonzero(splits < 0)
+        if len(missing):
+            if self.parser is None:
+                self.parser = self.parser_fn()
+            vecs[missing] = np.stack(self.parser.text2vec_batch([titles[i] for i in missing]))
+            self.n_inferred += len(missing)
+        return vecs
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+
+
+class ScoreWriter():
+    '''
+    Columnar output, one hdf5 dataset per column, preallocated for every product:
+        asin (S), cate (int32, -1: unknown), real (float32), cls (float32, n_cls), pred (int32), image_ok (bool)
+    real/cls are NaN and pred is -1 for products without a decodable image. <output>.state.json holds the
+    number of committed rows and is rewritten after every flushed batch, so an interrupted run resumes there.
+    '''
+    def __init__(self, path, products, n_cls, key, chunk_size=4096):
+        self.path = path
+        self.state_path = path + '.state.json'
+        self.n = len(products['asin'])
+        self.state = self.load_state(key)
+        if self.state is None:
+            self.state = {'key': key, 'n': self.n, 'done': 0}
+            chunk = (min(chunk_size, max(1, self.n)),)
+            with h5py.File(path, 'w') as out:
+                out.create_dataset('asin', data=np.array(products['asin'], dtype='S'), chunks=chunk)
+                out.create_dataset('cate', data=products['cate'].astype(np.int32), chunks=chunk)
+                out.create_dataset('real', (self.n,), dtype=np.float32, chunks=chunk, fillvalue=np.nan)
+                out.create_dataset('cls', (self.n, n_cls), dtype=np.float32, chunks=chunk + (n_cls,),
+                                   fillvalue=np.nan)
+                out.create_dataset('pred', (self.n,), dtype=np.int32, chunks=chunk, fillvalue=-1)
+                out.create_dataset('image_ok', (self.n,), dtype=np.bool_, chunks=chunk)
+            self.save_state()
+        self.out = h5py.File(path, 'a')
+
+    @property
+    def done(self):
+        return self.state['done']
+
+    def load_state(self, key):
+        if not os.path.exists(self.state_path) or not os.path.exists(self.path):
+            return None
+        with open(self.state_path) as f:
+            state = json.load(f)
+        if state['key'] != key or state['n'] != self.n:
+            return None
+        return state
+
+    def save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def write(self, start, real, cls, pred, ok):
+        end = start + len(ok)
+        self.out['real'][start:end] = real
+        self.out['cls'][start:end] = cls
+        self.out['pred'][start:end] = pred
+        self.out['image_ok'][start:end] = ok
+        self.out.flush()
+        self.state['done'] = end
+        self.save_state()
+
+    def close(self):
+        self.out.close()
+
+
+def score_batch(netD, images, docvecs, ok, device):
+    # scores of the rows with an image, NaN / -1 for the others
+    real = np.full(len(ok), np.nan, dtype=np.float32)
+    cls = np.full((len(ok), netD.n_cls), np.nan, dtype=np.float32)
+    pred = np.full(len(ok), -1, dtype=np.int32)
+    idx = np.flatnonzero(ok)
+    if len(idx):
+        with torch.inference_mode():
+            images = images[idx].to(device, non_blocking=True).float().div_(255)
+            docvecs = torch.from_numpy(docvecs[idx]).to(device, non_blocking=True)
+            s, c = netD(images, docvecs)
+            real[idx] = s.view(-1).float().cpu().numpy()
+            cls[idx] = c.float().cpu().numpy()
+            pred[idx] = c.argmax(1).int().cpu().numpy()
+    return real, cls, pred
+
+
+def screen(servertype, checkpoint, source='db', split='all', output=None, batch_size=512, n_workers=None,
+           device='cpu', threads=None, resume=True, log_every=20):
+    """
+    Scores every product of the catalogue with NetD and writes the real/fake and class scores to a columnar
+    hdf5 file (see ScoreWriter).
+    python screen_abuse.py screen <servertype> <netD checkpoint> [--source db|tsv] [--split all|train|dev]
+                           [--output <TRAIN_DIR_PATH>/screen_<source>.h5] [--batch-size 512] [--n-workers 4]
+    source db  : products of data.h5py with their stored docvec
+    source tsv : products of products.tsv. Products that are in data.h5py reuse the stored docvec, only
+                 the others are vectorized (loads spm/doc2vec)
+    """
+    logger = get_logger()
+    if source not in SOURCES:
+        raise ValueError('source should be one of {}: {}'.format(SOURCES, source))
+    splits = SPLITS if split == 'all' else [split]
+    if any(s not in SPLITS for s in splits):
+        raise ValueError('split should be all, train or dev: {}'.format(split))
+    if threads:
+        torch.set_num_threads(threads)
+
+    config = ges_Aonfig('./configs/config-{}.yaml'.format(servertype))
+    parse_config, db_config = config['PARSEMETA'], config['MAKEDB']
+    data_path = os.path.join(db_config['TRAIN_DIR_PATH'], 'data.h5py')
+    n_workers = db_config['N_WORKERS'] if n_workers is None else n_workers
+    output = output or os.path.join(db_config['TRAIN_DIR_PATH'], 'screen_{}.h5'.format(source))
+
+    st = time.time()
+    if source == 'db':
+        products = db_products(data_path, splits)
+    else:
+        products = tsv_products(parse_config['PARSE_DATA_PATH'], parse_config['CATEGORY_PATH'], data_path)
+    logger.info('%d products from %s (%.1f sec)' % (len(products['asin']), source, time.time() - st))
+
+    netD = load_discriminator(checkpoint, device)
+    device = torch.device(device)
+
+    def load_parser():
+        from parse_metadata import EcommerceDataParser
+        logger.info('loading the text encoder for products that are not in the db')
+        return EcommerceDataParser(parse_config, use=True)
+
+    # the output only resumes onto a run over the same products with the same model
+    key = '{}:{}:{}:{}'.format(source, split, os.path.abspath(checkpoint), os.path.getmtime(checkpoint))
+    writer = ScoreWriter(output, products, netD.n_cls, key if resume else key + ':%f' % time.time())
+    docvecs = DocvecReader(data_path, netD.docvec_size, load_parser)
+    start = writer.done
+    if start:
+        logger.info('resume from product %d/%d' % (start, writer.n))
+
+    images = ProductImages(db_config['IMAGE_DIR_PATH'], products['asin'][start:], netD.m_d * 16)
+    loader = DataLoader(images, batch_size=batch_size, shuffle=False, num_workers=n_workers,
+                        pin_memory=device.type == 'cuda')
+    st = time.time()
+    n_done, n_failed = 0, 0
+    try:
+        for i, (image, ok) in enumerate(loader):
+            lo, hi = start + n_done, start + n_done + len(ok)
+            ok = ok.numpy()
+            titles = products['title'][lo:hi] if 'title' in products else None
+            vecs = docvecs.read(products['split'][lo:hi], products['row'][lo:hi], titles)
+            real, cls, pred = score_batch(netD, image, vecs, ok, device)
+            writer.write(lo, real, cls, pred, ok)
+            n_done += len(ok)
+            n_failed += int((~ok).sum())
+            if (i + 1) % log_every == 0:
+                elapsed = time.time() - st
+                logger.info('%d/%d products, %.1f images/sec, %d without image' % (
+                    hi, writer.n, n_done / elapsed, n_failed))
+    finally:
+        writer.close()
+        docvecs.close()
+    elapsed = time.time() - st
+    logger.info('scored %d products in %.1f sec (%.1f images/sec), %d without image, %d docvecs inferred -> %s' % (
+        n_done, elapsed, n_done / max(elapsed, 1e-9), n_failed, docvecs.n_inferred, output))
+
+
+if __name__ == '__main__':
+    fire.Fire({'screen': screen})
@@ -0,0 +1,368 @@
+import io
+import json
+import time
+import queue
+import threading
+import collections
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fire
+import numpy as np
+import torch
+from PIL import Image
+
+from model import NetG
+from misc import get_logger, ges_Aonfig
+
+
+def load_generator(checkpoint_path, device='cpu'):
+    '''
+    NetG in eval mode (BatchNorm with running statistics, so an image does not depend on the rest of its batch).
+    checkpoint_path : netG state dict (netg_checkpoints/*.pth) or a full training checkpoint (checkpoints/*.pth).
+    The sizes are read from the weights, so they need not match the train.py arguments.
+    '''
+    state = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    if 'netG' in state:
+        state = state['netG']
+    n_l, n_t = state['lin_emb.weight'].shape
+    n_z = state['lin_zc.weight'].shape[1] - n_l
+    n_c = state['emb_bn.weight'].shape[0] // 8
+    netG = NetG(n_z=n_z, n_l=n_l, n_t=n_t, n_c=n_c)
+    netG.load_state_dict(state)
+    return netG.to(device).eval()
+
+
+def to_uint8_images(fake):
+    # NetG output in [0, 1], N x 3 x H x W -> N x H x W x 3 uint8 on the host
+    return fake.mul(255).round_().clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+
+
+def concat_image(images, ncols):
+    # grid of equally sized images, row by row, on a white background
+    nrows = (len(images) + ncols - 1) // ncols
+    h, w = images[0].shape[:2]
+    grid = np.full((nrows * h, ncols * w, 3), 255, dtype=np.uint8)
+    for i, image in enumerate(images):
+        r, c = divmod(i, ncols)
+        grid[r * h:(r + 1) * h, c * w:(c + 1) * w] = image
+    return grid
+
+
+def encode_image(array, fmt='png', quality=90):
+    buf = io.BytesIO()
+    if fmt == 'png':
+        Image.fromarray(array).save(buf, format='PNG')
+    elif fmt in ('jpeg', 'jpg'):
+        Image.fromarray(array).save(buf, format='JPEG', quality=quality)
+    else:
+        raise ValueError('format should be png or jpeg: {}'.format(fmt))
+    return buf.getvalue()
+
+
+class MicroBatcher:
+    '''
+    fn          : called with a list of items, returns the list of their results (same order)
+    max_batch   : most rows (sum of item sizes) per call
+    max_wait_ms : longest time the first item of a batch waits for more items
+
+    submit() is thread-safe and returns a Future. One worker thread takes the first waiting item and packs
+    whatever arrives until max_batch rows or the deadline, so a lone request waits at most max_wait_ms and
+    concurrent requests share one forward pass.
+    '''
+    def __init__(self, fn, max_batch=32, max_wait_ms=10.0):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.pending = None  # item taken from the queue that did not fit in the last batch
+        self.batch_sizes = collections.deque(maxlen=10000)
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, item, size=1):
+        future = Future()
+        self.queue.put((item, size, future))
+        return future
+
+    def next_batch(self):
+        first = self.pending or self.queue.get()
+        self.pending = None
+        batch, rows = [first], first[1]
+        deadline = time.perf_counter() + self.max_wait
+        while rows < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if rows + entry[1] > self.max_batch:
+                self.pending = entry
+                break
+            batch.append(entry)
+            rows += entry[1]
+        return batch, rows
+
+    def worker(self):
+        while True:
+            batch, rows = self.next_batch()
+            self.batch_sizes.append(rows)
+            try:
+                results = self.fn([item for item, _, _ in batch])
+            except Exception:
+                # run the items one by one, so a bad item only fails its own request
+                for item, _, future in batch:
+                    try:
+                        future.set_result(self.fn([item])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class ImageGenerator:
+    '''
+    netG        : generator from load_generator
+    parser      : EcommerceDataParser with spm and doc2vec loaded (for text requests), None: docvec requests only
+    max_batch   : most images per forward pass
+    max_wait_ms : batching deadline, see MicroBatcher
+
+    A request is a dict: text (or docvec), n images (default 1), seed (optional, same seed -> same images),
+    format png|jpeg, quality, ncols. n > 1 images are returned as one grid image.
+    '''
+    def __init__(self, netG, parser=None, max_batch=32, max_wait_ms=10.0, device='cpu'):
+        self.netG = netG
+        self.parser = parser
+        self.device = torch.device(device)
+        self.batcher = MicroBatcher(self.generate_batch, max_batch=max_batch, max_wait_ms=max_wait_ms)
+        self.latencies = collections.deque(maxlen=10000)
+        self.n_requests = 0
+        self.n_images = 0
+        self.started = time.time()
+        self.stats_lock = threading.Lock()
+
+    def docvec(self, request):
+        if 'docvec' in request:
+            vec = np.asarray(request['docvec'], dtype=np.float32)
+        elif self.parser is None:
+            raise ValueError('no text encoder loaded, send a docvec')
+        elif 'text' not in request:
+            raise ValueError('the request needs a text or a docvec')
+        else:
+            vec = np.asarray(self.parser.text2vec(request['text']), dtype=np.float32)
+        if vec.shape != (self.netG.n_t,):
+            raise ValueError('docvec should have {} values: {}'.format(self.netG.n_t, vec.shape))
+        return vec
+
+    def generate_batch(self, items):
+        # items: (docvec, n, seed). One forward pass for all images of all items
+        captions, noises = [], []
+        for vec, n, seed in items:
+            generator = torch.Generator()
+            if seed is not None:
+                generator.manual_seed(seed)
+            else:
+                generator.seed()
+            noises.append(torch.randn(n, self.netG.n_z, generator=generator))
+            captions.append(torch.from_numpy(vec).expand(n, -1))
+        with torch.inference_mode():
+            noise = torch.cat(noises).to(self.device)
+            caption = torch.cat(captions).to(self.device)
+            images = to_uint8_images(self.netG(noise, caption))
+        results, start = [], 0
+        for _, n, _ in items:
+            results.append(images[start:start + n])
+            start += n
+        return results
+
+    def options(self, request):
+        # n, seed, format, quality, ncols of a request, checked before it joins a batch (ValueError -> 400)
+        def integer(key, default, low, high):
+            value = request.get(key, default)
+            if value is None:
+                return None
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError('{} should be an integer: {!r}'.format(key, value))
+            if not low <= value <= high:
+                raise ValueError('{} should be in [{}, {}]: {}'.format(key, low, high, value))
+            return value
+
+        n = integer('n', 1, 1, self.batcher.max_batch)
+        seed = integer('seed', None, 0, 2 ** 63 - 1)
+        fmt = request.get('format', 'png')
+        if not isinstance(fmt, str) or fmt.lower() not in ('png', 'jpeg', 'jpg'):
+            raise ValueError('format should be png or jpeg: {!r}'.format(fmt))
+        quality = integer('quality', 90, 1, 100)
+        ncols = integer('ncols', min(n, 8), 1, n)
+        return n, seed, fmt.lower(), quality, ncols
+
+    def generate(self, request):
+        # -> (image bytes, content type)
+        st = time.perf_counter()
+        n, seed, fmt, quality, ncols = self.options(request)
+        images = self.batcher.submit((self.docvec(request), n, seed), size=n).result()
+        image = images[0] if n == 1 else concat_image(images, ncols)
+        body = encode_image(image, fmt, quality)
+        with self.stats_lock:
+            self.latencies.append(time.perf_counter() - st)
+            self.n_requests += 1
+            self.n_images += n
+        return body, 'image/png' if fmt == 'png' else 'image/jpeg'
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {'requests': self.n_requests, 'images': self.n_images,
+                     'uptime_sec': time.time() - self.started}
+        if len(latencies):
+            stats.update(p50_ms=float(np.percentile(latencies, 50)), p99_ms=float(np.percentile(latencies, 99)),
+                         mean_ms=float(latencies.mean()))
+        if self.batcher.batch_sizes:
+            stats['mean_batch'] = float(np.mean(self.batcher.batch_sizes))
+        if self.parser is not None and self.parser.text2vec_cache_info() is not None:
+            stats['text2vec_cache'] = self.parser.text2vec_cache_info()
+        return stats
+
+
+class Server(ThreadingHTTPServer):
+    # the default listen backlog of 5 drops connections of concurrent clients (1 s SYN retry)
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        # commits the text2vec vectors that are still pending
+        generator = getattr(self.RequestHandlerClass, 'generator', None)
+        if generator is not None and generator.parser is not None:
+            generator.parser.close_text2vec_cache()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # POST /generate {json request} -> image, GET /stats -> json, GET /health
+    protocol_version = 'HTTP/1.1'
+    generator = None
+
+    def send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, obj):
+        self.send(code, json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.generator.stats())
+        elif self.path == '/health':
+            self.send_json(200, {'ok': True})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError('the request body must be a json object, got {}'.format(type(request).__name__))
+            body, content_type = self.generator.generate(request)
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send(200, body, content_type)
+
+    def log_message(self, format, *args):
+        pass  # no line per request, see /stats
+
+
+def make_server(checkpoint, servertype=None, host='127.0.0.1', port=8000, max_batch=32, max_wait_ms=10.0,
+                device='cpu', threads=None):
+    logger = get_logger()
+    if threads:
+        torch.set_num_threads(threads)
+    netG = load_generator(checkpoint, device)
+    parser = None
+    if servertype:
+        from parse_metadata import EcommerceDataParser
+        config = ges_Aonfig('./configs/config-{}.yaml'.format(servertype))['PARSEMETA']
+        parser = EcommerceDataParser(config, use=True)
+    handler = type('BoundHandler', (Handler,), {'generator': ImageGenerator(
+        netG, parser, max_batch=max_batch, max_wait_ms=max_wait_ms, device=device)})
+    server = Server((host, port), handler)
+    logger.info('NetG (n_z=%d, n_t=%d) on %s, max batch %d, max wait %.1f ms, listening on %s:%d' % (
+        netG.n_z, netG.n_t, device, max_batch, max_wait_ms, host, server.server_address[1]))
+    return server
+
+
+def serve(checkpoint, servertype=None, host='127.0.0.1', port=8000, max_batch=32, max_wait_ms=10.0, device='cpu',
+          threads=None):
+    """
+    python serve.py serve <netG checkpoint> [--servertype real] [--port 8000] [--max-batch 32] [--max-wait-ms 10]
+    curl -d '{"text": "solid body electric guitar", "n": 4}' localhost:8000/generate > out.png
+    Without --servertype only {"docvec": [...]} requests are accepted (no spm/doc2vec loaded).
+    """
+    server = make_server(checkpoint, servertype, host, port, max_batch, max_wait_ms, device, threads)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def bench(checkpoint, n_requests=512, concurrency=32, n=1, max_batch=32, max_wait_ms=10.0, device='cpu',
+          threads=None, url=None, fmt='png'):
+    """
+    python serve.py bench <netG checkpoint> [--concurrency 32] [--max-batch 32] [--max-wait-ms 10]
+    Sends n_requests docvec requests from `concurrency` client threads to an in-process server (or --url) and
+    prints throughput and client-side p50/p99 latency. Compare --max-batch 1 for the unbatched baseline.
+    """
+    server = None
+    if url is None:
+        server = make_server(checkpoint, None, '127.0.0.1', 0, max_batch, max_wait_ms, device, threads)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+    n_t = load_generator(checkpoint).n_t
+    rng = np.random.RandomState(0)
+    docvecs = rng.normal(0, 0.1, size=(64, n_t)).astype(np.float32)
+
+    def call(i):
+        body = json.dumps({'docvec': docvecs[i % len(docvecs)].tolist(), 'n': n, 'seed': i, 'format': fmt})
+        st = time.perf_counter()
+        req = urllib.request.Request(url + '/generate', data=body.encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as response:
+            response.read()
+        return time.perf_counter() - st
+
+    call(0)  # warm up
+    st = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = np.array(list(pool.map(call, range(n_requests)))) * 1000
+    elapsed = time.perf_counter() - st
+    with urllib.request.urlopen(url + '/stats') as response:
+        stats = json.loads(response.read())
+    result = {'requests': n_requests, 'concurrency': concurrency, 'max_batch': max_batch, 'max_wait_ms': max_wait_ms,
+              'images_per_sec': n_requests * n / elapsed, 'requests_per_sec': n_requests / elapsed,
+              'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+              'mean_batch': stats.get('mean_batch')}
+    print(json.dumps(result, indent=2))
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    fire.Fire({'serve': serve, 'bench': bench})
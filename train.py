@@ -1,23 +1,52 @@
 import argparse
 import os
+import random
+import resource
+from contextlib import nullcontext
 from time import time
+import numpy as np
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
+import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from model import NetD, NetG
-from data_loader import ImTextDataset
+from data_loader import ImTextDataset, DevicePrefetcher
+from metrics import TrainMetrics
+from checkpoint import AsyncCheckpointer, to_cpu, load_latest_checkpoint
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 
+# model inside a DataParallel/DistributedDataParallel wrapper (or the model itself)
+def unwrap(model):
+    return model.module if isinstance(model, (nn.DataParallel, DistributedDataParallel)) else model
+
+
 class TACGAN():
 
     def __init__(self, args):
         self.lr = args.lr
-        self.cuda = args.use_cuda
+        self.cuda = args.use_cuda and torch.cuda.is_available()
+        # --distributed: one process per device, launched by torchrun (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR)
+        self.distributed = args.distributed
+        self.rank, self.world_size, self.local_rank = 0, 1, 0
+        if self.distributed:
+            dist.init_process_group(backend=args.dist_backend or ('nccl' if self.cuda else 'gloo'))
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+            self.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        self.is_main = self.rank == 0 # only rank 0 logs and writes files
+        self.device = torch.device('cuda', self.local_rank) if self.cuda else torch.device('cpu')
+        if self.cuda:
+            torch.cuda.set_device(self.device)
+        self.precision = args.precision
+        if self.precision == 'fp16' and not self.cuda:
+            raise ValueError('--precision fp16 needs cuda, use bf16 on cpu')
+        self.amp_dtype = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}[self.precision]
         self.batch_size = args.batch_size
         self.image_size = args.image_size
         self.epochs = args.epochs
@@ -27,46 +56,74 @@ class TACGAN():
         self.save_prefix = args.save_prefix
         self.continue_training = args.continue_training
         self.continue_epoch = args.continue_epoch
+        self.resume = args.resume
+        # full training state (models, optimizers, epoch, RNG) for --resume
+        self.ckpt_dir = os.path.join(self.save_dir, 'checkpoints')
+        self.ckpt_prefix = self.save_prefix + '_' if self.save_prefix else ''
+        self.checkpointer = None
         self.netG_path = args.netg_path
         self.netD_path = args.netd_path
         self.save_after = args.save_after
+        self.log_every = args.log_every
+        self.fused_d = args.fused_d
         self.trainset_loader = None
         self.evalset_loader = None  
         self.num_workers = args.num_workers
+        self.meta_mode = args.meta_mode
+        self.image_mode = args.image_mode
+        self.image_dir = args.image_dir
         self.docvec_size = args.docvec_size
         self.n_z = args.n_z # length of the noise vector
         self.nl_d = args.nl_d
         self.nl_g = args.nl_g
         self.nf_g = args.nf_g
         self.nf_d = args.nf_d
-        self.bce_loss = nn.BCELoss()
+        # NetD is called with logits=True: the sigmoid is folded into the loss, which is equivalent and autocast-safe
+        self.bce_loss = nn.BCEWithLogitsLoss()
         self.nll_loss = nn.NLLLoss()
         self.mse_loss = nn.MSELoss()
         self.class_filename = args.class_filename
         class_path = os.path.join(self.data_root, self.dataset, self.class_filename)
         with open(class_path) as f:
             self.num_classes = len([l for l in f])
-        print(self.num_classes)
+        self.log(self.num_classes)
         self.netD = NetD(n_cls=self.num_classes, n_t=self.nl_d, n_f=self.nf_d, docvec_size=self.docvec_size)
         self.netG = NetG(n_z=self.n_z, n_l=self.nl_g, n_c=self.nf_g, n_t=self.docvec_size)
 
         if self.continue_training:
             self.loadCheckpoints()
 
+        if args.sync_bn and not (self.distributed and self.cuda):
+            raise ValueError('--sync-bn needs --distributed on cuda (SyncBatchNorm only runs on gpu)')
+        if args.sync_bn:
+            # batch statistics over the global batch instead of the per-process one
+            self.netD = nn.SyncBatchNorm.convert_sync_batchnorm(self.netD)
+            self.netG = nn.SyncBatchNorm.convert_sync_batchnorm(self.netG)
+
         # convert to cuda tensors
-        if self.cuda and torch.cuda.is_available():
-            print('CUDA is enabled')
-            self.netD = nn.DataParallel(self.netD).cuda()
-            self.netG = nn.DataParallel(self.netG).cuda()
-            self.bce_loss = self.bce_loss.cuda()
-            self.nll_loss = self.nll_loss.cuda()
-            self.mse_loss = self.mse_loss.cuda()
+        if self.cuda:
+            self.log('CUDA is enabled')
+        self.netD = self.netD.to(self.device)
+        self.netG = self.netG.to(self.device)
+        if self.distributed:
+            device_ids = [self.local_rank] if self.cuda else None
+            self.netD = DistributedDataParallel(self.netD, device_ids=device_ids)
+            self.netG = DistributedDataParallel(self.netG, device_ids=device_ids)
+        elif self.cuda:
+            self.netD = nn.DataParallel(self.netD)
+            self.netG = nn.DataParallel(self.netG)
 
         # optimizers for netD and netG
         self.optimizerD = optim.Adam(params=self.netD.parameters(), lr=self.lr, betas=(0.5, 0.999))
         self.optimizerG = optim.Adam(params=self.netG.parameters(), lr=self.lr, betas=(0.5, 0.999))
+        # loss scaling is only needed for fp16 (bf16 has the fp32 exponent range), one scaler per optimizer
+        self.scalerD = torch.amp.GradScaler(self.device.type, enabled=self.precision == 'fp16')
+        self.scalerG = torch.amp.GradScaler(self.device.type, enabled=self.precision == 'fp16')
 
         # create dir for saving checkpoints and other results if do not exist
+        if not self.is_main:
+            self.metrics = TrainMetrics(log_every=self.log_every) # timed, but not written
+            return
         if not os.path.exists(self.save_dir):
             os.makedirs(self.save_dir)
         if not os.path.exists(os.path.join(self.save_dir,'netd_checkpoints')):
@@ -76,6 +133,13 @@ class TACGAN():
         if not os.path.exists(os.path.join(self.save_dir,'generated_images')):            
             os.makedirs(os.path.join(self.save_dir,'generated_images'))
 
+        self.checkpointer = AsyncCheckpointer(self.ckpt_dir, prefix=self.ckpt_prefix, keep=args.keep_checkpoints)
+
+        # step timings and losses, aggregated every --log-every steps
+        self.metrics = TrainMetrics(path=args.metrics_file or os.path.join(self.save_dir, 'metrics.jsonl'),
+                                    log_every=self.log_every, tb_dir=args.tensorboard_dir,
+                                    sync=torch.cuda.synchronize if self.cuda and args.metrics_sync else None)
+
     # start training process
     def train(self):
         # write to the log file and print it
@@ -86,26 +150,52 @@ class TACGAN():
         log_msg += 'Number of epochs:%d\nlr:%f\n'%(self.epochs,self.lr)
         log_msg += 'nz:%d\nnl-d:%d\nnl-g:%d\n'%(self.n_z, self.nl_d, self.nl_g)
         log_msg += 'nf-g:%d\nnf-d:%d\n'%(self.nf_g, self.nf_d)  
+        log_msg += 'Precision:%s\n'%(self.precision)
+        log_msg += 'Fused NetD update:%s\n'%(self.fused_d)
+        if self.distributed:
+            log_msg += 'Processes:%d (global batch size:%d)\n'%(self.world_size, self.batch_size * self.world_size)
         log_msg += '********************************************\n\n'
-        print(log_msg)
-        with open(os.path.join(self.save_dir, 'training_log.txt'),'a') as log_file:
-            log_file.write(log_msg)
+        self.log(log_msg, log_file=True)
         # load trainset and evalset
-        imtext_ds = ImTextDataset(data_dir=self.data_root, dataset=self.dataset, train=True, image_size=self.image_size)
-        self.trainset_loader = DataLoader(dataset=imtext_ds, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
-        print("Dataset loaded successfuly")
+        imtext_ds = ImTextDataset(data_dir=self.data_root, dataset=self.dataset, train=True, image_size=self.image_size,
+                                  meta_mode=self.meta_mode, image_mode=self.image_mode,
+                                  image_dir=self.image_dir)
+        # --batch-size is per process, each process reads its own 1/world_size of the (shuffled) dataset
+        sampler = DistributedSampler(imtext_ds, shuffle=True) if self.distributed else None
+        self.trainset_loader = DataLoader(dataset=imtext_ds, batch_size=self.batch_size, shuffle=sampler is None,
+                                          sampler=sampler, num_workers=self.num_workers, pin_memory=self.cuda)
+        self.log("Dataset loaded successfuly")
         # load checkpoints for continuing training
+        start_epoch, netd_losses, netg_losses = 0, [], []
+        if self.resume:
+            start_epoch, netd_losses, netg_losses = self.resumeCheckpoint()
 
         # repeat for the number of epochs
-        netd_losses = []
-        netg_losses = []
-        for epoch in range(self.epochs):
-            netd_loss, netg_loss = self.trainEpoch(epoch)
-            netd_losses.append(netd_loss)
-            netg_losses.append(netg_loss)
-            self.saveGraph(netd_losses,netg_losses)
-            #self.evalEpoch(epoch)
-            self.saveCheckpoints(epoch)
+        completed = False
+        try:
+            for epoch in range(start_epoch, self.epochs):
+                if self.distributed:
+                    sampler.set_epoch(epoch) # a different shuffle every epoch, the same on all processes
+                netd_loss, netg_loss = self.trainEpoch(epoch)
+                netd_losses.append(netd_loss)
+                netg_losses.append(netg_loss)
+                if self.is_main:
+                    self.saveGraph(netd_losses,netg_losses)
+                    #self.evalEpoch(epoch)
+                with self.metrics.timed('checkpoint'): # only the copy to cpu, the files are written in the background
+                    self.saveCheckpoints(epoch, netd_losses, netg_losses)
+            completed = True
+        finally:
+            try:
+                if self.checkpointer is not None:
+                    self.checkpointer.close() # wait for the last checkpoint
+            except Exception as e:
+                if completed:
+                    raise
+                # keep the training error that is already propagating
+                self.log('checkpoint writer failed: %r\n' % e, log_file=True)
+            finally:
+                self.metrics.close()
 
     # train epoch
     def trainEpoch(self, epoch):
@@ -115,81 +205,168 @@ class TACGAN():
         netd_loss_sum = 0
         netg_loss_sum = 0
         start_time = time()
-        for i, (images, labels, captions) in enumerate(self.trainset_loader):
+        # constant targets are created once on the device and sliced for a smaller last batch
+        ones = torch.ones(self.batch_size, 1, device=self.device)
+        zeros = torch.zeros(self.batch_size, 1, device=self.device)
+        self.metrics.start_epoch(epoch)
+        # batches arrive already on the device, copied on a side stream while the previous step runs
+        for i, (images, labels, captions) in enumerate(DevicePrefetcher(self.trainset_loader, self.device)):
+            self.metrics.phase('data')
             batch_size = images.size(0) # !batch size my be different (from self.batch_size) for the last batch
-            images, labels, captions = Variable(images), Variable(labels), Variable(captions) # !labels should be LongTensor
-            labels = labels.type(torch.FloatTensor) # convert to FloatTensor (from DoubleTensor)
-            lbl_real = Variable(torch.ones(batch_size, 1))
-            lbl_fake = Variable(torch.zeros(batch_size, 1))
-            noise = Variable(torch.randn(batch_size, self.n_z)) # create random noise
-            noise.data.normal_(0,1) # normalize the noise
-            rnd_perm1 = torch.randperm(batch_size) # random permutations for different sets of training tuples
-            rnd_perm2 = torch.randperm(batch_size)
-            rnd_perm3 = torch.randperm(batch_size)
-            rnd_perm4 = torch.randperm(batch_size)
-            if self.cuda:
-                images, labels, captions = images.cuda(), labels.cuda(), captions.cuda()
-                lbl_real, lbl_fake = lbl_real.cuda(), lbl_fake.cuda()
-                noise = noise.cuda()
-                rnd_perm1, rnd_perm2, rnd_perm3, rnd_perm4 = rnd_perm1.cuda(), rnd_perm2.cuda(), rnd_perm3.cuda(), rnd_perm4.cuda()
+            lbl_real = ones[:batch_size]
+            lbl_fake = zeros[:batch_size]
+            noise = torch.randn(batch_size, self.n_z, device=self.device) # create random noise
+            rnd_perm1 = torch.randperm(batch_size, device=self.device) # random permutations for different sets of training tuples
+            rnd_perm2 = torch.randperm(batch_size, device=self.device)
+            rnd_perm3 = torch.randperm(batch_size, device=self.device)
+            rnd_perm4 = torch.randperm(batch_size, device=self.device)
+            labels = F.one_hot(labels, self.num_classes).float() # labels are class indices, one-hot targets are built on the device
+            if images.dtype == torch.uint8:
+                images = images.float().div_(255) # shard images are uint8, scale after the (smaller) copy
             
             ############### Update NetD ###############
-            self.netD.zero_grad()       
-            # train with wrong image, wrong label, real caption
-            outD_wrong, outC_wrong = self.netD(images[rnd_perm1], captions[rnd_perm2])
-            # lossD_wrong = self.bce_loss(outD_wrong, lbl_fake)
-            lossD_wrong = self.bce_loss(outD_wrong, lbl_fake) + self.mse_loss(outD_wrong, lbl_fake)
-            lossC_wrong = self.bce_loss(outC_wrong, labels[rnd_perm1])
-
-            # train with real image, real label, real caption
-            outD_real, outC_real = self.netD(images, captions)
-            #lossD_real = self.bce_loss(outD_real, lbl_real)
-            lossD_real = self.bce_loss(outD_real, lbl_real) + self.mse_loss(outD_real, lbl_real)
-            lossC_real = self.bce_loss(outC_real, labels)
-
-            # train with fake image, real label, real caption
-            fake = self.netG(noise, captions)
-            outD_fake, outC_fake = self.netD(fake.detach(), captions[rnd_perm3])
-            #lossD_fake = self.bce_loss(outD_fake, lbl_fake)
-            lossD_fake = self.bce_loss(outD_fake, lbl_fake) + self.mse_loss(outD_fake, lbl_fake)
-            lossC_fake = self.bce_loss(outC_fake, labels[rnd_perm3])
-            
-            # backward and forwad for NetD
-            netD_loss = lossC_wrong+lossC_real+lossC_fake + lossD_wrong+lossD_real+lossD_fake
-            netD_loss.backward()
-            self.optimizerD.step()      
+            if self.fused_d != 'off':
+                netD_loss = self.updateD_fused(images, labels, captions, noise, lbl_real, lbl_fake, rnd_perm1, rnd_perm2, rnd_perm3)
+            else:
+                netD_loss = self.updateD(images, labels, captions, noise, lbl_real, lbl_fake, rnd_perm1, rnd_perm2, rnd_perm3)
+            self.metrics.phase('d_step')
 
             ########## Update NetG ##########
-            # train with fake data
+            # train with fake data. NetD is only a loss here: it is called without its DDP wrapper so
+            # that its (unused) gradients are not all-reduced
             self.netG.zero_grad()
-            noise.data.normal_(0,1) # normalize the noise vector
-            fake = self.netG(noise, captions[rnd_perm4])
-            d_fake, c_fake = self.netD(fake, captions[rnd_perm4])
-            #lossD_fake_G = self.bce_loss(d_fake, lbl_real)
-            lossD_fake_G = self.mse_loss(d_fake, lbl_real)
-            lossC_fake_G = self.bce_loss(c_fake, labels[rnd_perm4])
-            netG_loss = lossD_fake_G + lossC_fake_G 
-            netG_loss.backward()    
-            self.optimizerG.step()
-            
-            netd_loss_sum += netD_loss.item()
-            netg_loss_sum += netG_loss.item()
-            ### print progress info ###
-            print('Epoch %d/%d, %.2f%% completed. Loss_NetD: %.4f, Loss_NetG: %.4f'
-                  %(epoch, self.epochs,(float(i)/len(self.trainset_loader))*100, netD_loss.item(), netG_loss.item()))
+            noise.normal_(0,1) # resample the noise vector
+            with self.autocast():
+                fake = self.netG(noise, captions[rnd_perm4])
+                d_fake, c_fake = self.strip_ddp(self.netD)(fake, captions[rnd_perm4], logits=True)
+                lossD_fake_G = self.mse_loss(torch.sigmoid(d_fake.float()), lbl_real)
+                lossC_fake_G = self.bce_loss(c_fake, labels[rnd_perm4])
+                netG_loss = lossD_fake_G + lossC_fake_G
+            self.scalerG.scale(netG_loss).backward()
+            self.scalerG.step(self.optimizerG)
+            self.scalerG.update()
+            self.metrics.phase('g_step')
+
+            netD_loss, netG_loss = netD_loss.item(), netG_loss.item()
+            netd_loss_sum += netD_loss
+            netg_loss_sum += netG_loss
+            ### print progress info, averaged over the last --log-every steps ###
+            record = self.metrics.end_step(batch_size, loss_d=netD_loss, loss_g=netG_loss)
+            if record is not None:
+                self.log('Epoch %d/%d, %.2f%% completed. Loss_NetD: %.4f, Loss_NetG: %.4f (%.1f samples/s, data %.0f%%)'
+                         %(epoch, self.epochs,(float(i+1)/len(self.trainset_loader))*100, record['loss_d'], record['loss_g'],
+                           record['samples_per_sec'], record['data_wait']*100))
 
         end_time = time()
+        summary = self.metrics.end_epoch()
         netd_avg_loss = netd_loss_sum / len(self.trainset_loader)
         netg_avg_loss = netg_loss_sum / len(self.trainset_loader)
+        if self.distributed:
+            # average of the per-process averages
+            avg = torch.tensor([netd_avg_loss, netg_avg_loss], dtype=torch.float64, device=self.device)
+            dist.all_reduce(avg)
+            netd_avg_loss, netg_avg_loss = (avg / self.world_size).tolist()
         epoch_time = (end_time-start_time)/60
         log_msg = '-------------------------------------------\n'
         log_msg += 'Epoch %d took %.2f minutes\n'%(epoch, epoch_time)
+        log_msg += 'Throughput: %.1f samples/s (%s), peak memory: %.1f MB\n' %(
+            len(self.trainset_loader.sampler) * self.world_size / (end_time-start_time), self.precision, self.peakMemory())
+        log_msg += 'Time per step: data %.1f ms, NetD %.1f ms, NetG %.1f ms (waiting for data %.1f%%)\n' %(
+            summary['data_time']*1000, summary['d_step_time']*1000, summary['g_step_time']*1000, summary['data_wait']*100)
         log_msg += 'NetD average loss: %.4f, NetG average loss: %.4f\n\n' %(netd_avg_loss, netg_avg_loss)
-        print(log_msg)
-        with open(os.path.join(self.save_dir, 'training_log.txt'),'a') as log_file:
-            log_file.write(log_msg)
+        self.log(log_msg, log_file=True)
         return netd_avg_loss, netg_avg_loss
 
+    # NetD update with three forward calls: wrong pair, real pair, fake image
+    def updateD(self, images, labels, captions, noise, lbl_real, lbl_fake, rnd_perm1, rnd_perm2, rnd_perm3):
+        # one backward per part, the gradients add up as with a single backward of the sum.
+        # Under DDP only the last backward all-reduces (the first two accumulate locally in no_sync)
+        self.netD.zero_grad()
+        with self.no_sync(self.netD):
+            # train with wrong image, wrong label, real caption
+            with self.autocast():
+                outD_wrong, outC_wrong = self.netD(images[rnd_perm1], captions[rnd_perm2], logits=True)
+                lossD_wrong = self.d_loss(outD_wrong, lbl_fake)
+                lossC_wrong = self.bce_loss(outC_wrong, labels[rnd_perm1])
+            self.scalerD.scale(lossD_wrong + lossC_wrong).backward()
+
+            # train with real image, real label, real caption
+            with self.autocast():
+                outD_real, outC_real = self.netD(images, captions, logits=True)
+                lossD_real = self.d_loss(outD_real, lbl_real)
+                lossC_real = self.bce_loss(outC_real, labels)
+            self.scalerD.scale(lossD_real + lossC_real).backward()
+
+        # train with fake image, real label, real caption
+        with self.autocast():
+            fake = self.netG(noise, captions)
+            outD_fake, outC_fake = self.netD(fake.detach(), captions[rnd_perm3], logits=True)
+            lossD_fake = self.d_loss(outD_fake, lbl_fake)
+            lossC_fake = self.bce_loss(outC_fake, labels[rnd_perm3])
+        self.scalerD.scale(lossD_fake + lossC_fake).backward()
+
+        # backward and forwad for NetD
+        netD_loss = (lossC_wrong+lossC_real+lossC_fake + lossD_wrong+lossD_real+lossD_fake).detach()
+        self.scalerD.step(self.optimizerD)
+        self.scalerD.update()
+        return netD_loss
+
+    # NetD update with the wrong/real/fake inputs concatenated into one forward call (--fused-d).
+    # group: every part keeps its own BatchNorm statistics, the same update as updateD
+    # joint: BatchNorm statistics over all 3 x batch size inputs (real and fake mixed in one batch)
+    def updateD_fused(self, images, labels, captions, noise, lbl_real, lbl_fake, rnd_perm1, rnd_perm2, rnd_perm3):
+        batch_size = images.size(0)
+        self.netD.zero_grad()
+        with self.autocast():
+            fake = self.netG(noise, captions)
+            outD, outC = self.netD(torch.cat([images[rnd_perm1], images, fake.detach()]),
+                                   torch.cat([captions[rnd_perm2], captions, captions[rnd_perm3]]),
+                                   logits=True, bn_groups=3 if self.fused_d == 'group' else 1)
+            outD_wrong, outD_real, outD_fake = outD.split(batch_size)
+            outC_wrong, outC_real, outC_fake = outC.split(batch_size)
+            lossD_wrong = self.d_loss(outD_wrong, lbl_fake)
+            lossC_wrong = self.bce_loss(outC_wrong, labels[rnd_perm1])
+            lossD_real = self.d_loss(outD_real, lbl_real)
+            lossC_real = self.bce_loss(outC_real, labels)
+            lossD_fake = self.d_loss(outD_fake, lbl_fake)
+            lossC_fake = self.bce_loss(outC_fake, labels[rnd_perm3])
+            netD_loss = lossC_wrong+lossC_real+lossC_fake + lossD_wrong+lossD_real+lossD_fake
+        self.scalerD.scale(netD_loss).backward()
+        self.scalerD.step(self.optimizerD)
+        self.scalerD.update()
+        return netD_loss.detach()
+
+    # print (and append to training_log.txt) on rank 0 only
+    def log(self, msg, log_file=False):
+        if not self.is_main:
+            return
+        print(msg)
+        if log_file:
+            with open(os.path.join(self.save_dir, 'training_log.txt'),'a') as f:
+                f.write(msg)
+
+    # skip the gradient all-reduce of a DDP model inside the context, a no-op otherwise
+    def no_sync(self, model):
+        return model.no_sync() if isinstance(model, DistributedDataParallel) else nullcontext()
+
+    # the model inside a DDP wrapper, a DataParallel model is kept so the batch stays split over the gpus
+    def strip_ddp(self, model):
+        return model.module if isinstance(model, DistributedDataParallel) else model
+
+    # autocast context for the forward passes, a no-op for fp32
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.precision != 'fp32')
+
+    # real/fake loss of NetD from its logits: bce + mse on the sigmoid, the mse in fp32
+    def d_loss(self, out, target):
+        return self.bce_loss(out, target) + self.mse_loss(torch.sigmoid(out.float()), target)
+
+    # peak device memory in MB (max rss of the process on cpu)
+    def peakMemory(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
     # eval epoch                   
     def evalEpoch(self, epoch):
         #self.netD.eval()
@@ -206,16 +383,66 @@ class TACGAN():
         plt.savefig(os.path.join(self.save_dir,'loss_graph.png'))
         plt.close()
 
-    # save after each epoch
-    def saveCheckpoints(self, epoch):
-        if epoch%self.save_after==0:
-            name_netD = "netd_checkpoints/netD_" + self.save_prefix + "_epoch_" + str(epoch) + ".pth"
-            name_netG = "netg_checkpoints/netG_" + self.save_prefix + "_epoch_" + str(epoch) + ".pth"
-            torch.save(self.netD.module.state_dict(), os.path.join(self.save_dir, name_netD))
-            torch.save(self.netG.module.state_dict(), os.path.join(self.save_dir, name_netG))
-            print("Checkpoints for epoch %d saved successfuly" %(epoch))
+    # RNG state of this process
+    def rngState(self):
+        return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if self.cuda else None}
+
+    def setRngState(self, rng):
+        random.setstate(rng['python'])
+        np.random.set_state(rng['numpy'])
+        torch.set_rng_state(rng['torch'])
+        if self.cuda and rng['cuda'] is not None:
+            torch.cuda.set_rng_state_all(rng['cuda'])
+
+    # save after each epoch (called on every process, only rank 0 writes)
+    def saveCheckpoints(self, epoch, netd_losses, netg_losses):
+        if epoch%self.save_after!=0 and epoch!=self.epochs-1:
+            return
+        # the RNG state of every process, so that each one resumes its own random stream
+        rng = [self.rngState()]
+        if self.distributed:
+            rng = [None] * self.world_size if self.is_main else None
+            dist.gather_object(self.rngState(), rng, dst=0)
+        if not self.is_main:
+            return
+
+        # snapshot on the host now, written to disk by the checkpointer thread while the next epoch trains
+        netD_state = to_cpu(unwrap(self.netD).state_dict())
+        netG_state = to_cpu(unwrap(self.netG).state_dict())
+        state = {'epoch': epoch, 'netD': netD_state, 'netG': netG_state,
+                 'optimizerD': to_cpu(self.optimizerD.state_dict()), 'optimizerG': to_cpu(self.optimizerG.state_dict()),
+                 'scalerD': self.scalerD.state_dict(), 'scalerG': self.scalerG.state_dict(),
+                 'netd_losses': list(netd_losses), 'netg_losses': list(netg_losses),
+                 'global_step': self.metrics.global_step, 'rng': rng}
+        # model-only state dicts as before, e.g. for the notebooks
+        name_netD = "netd_checkpoints/netD_" + self.save_prefix + "_epoch_" + str(epoch) + ".pth"
+        name_netG = "netg_checkpoints/netG_" + self.save_prefix + "_epoch_" + str(epoch) + ".pth"
+        self.checkpointer.save(epoch, state, extra_files=[(netD_state, os.path.join(self.save_dir, name_netD)),
+                                                          (netG_state, os.path.join(self.save_dir, name_netG))])
+        self.log("Checkpoints for epoch %d queued for saving" %(epoch))
+
+    # restore the latest full checkpoint of <save-dir>/checkpoints, returns the epoch to start from and the loss history
+    def resumeCheckpoint(self):
+        state = load_latest_checkpoint(self.ckpt_dir, self.ckpt_prefix)
+        if state is None:
+            self.log("No checkpoint to resume from in %s, starting from scratch" %(self.ckpt_dir))
+            return 0, [], []
+        unwrap(self.netD).load_state_dict(state['netD'])
+        unwrap(self.netG).load_state_dict(state['netG'])
+        self.optimizerD.load_state_dict(state['optimizerD'])
+        self.optimizerG.load_state_dict(state['optimizerG'])
+        self.scalerD.load_state_dict(state['scalerD'])
+        self.scalerG.load_state_dict(state['scalerG'])
+        self.metrics.global_step = state['global_step']
+        rng = state['rng']
+        if len(rng) != self.world_size:
+            self.log("Checkpoint was written by %d processes, RNG streams are not restored exactly" %(len(rng)))
+        self.setRngState(rng[self.rank % len(rng)])
+        self.log("Resumed from the checkpoint of epoch %d" %(state['epoch']))
+        return state['epoch'] + 1, state['netd_losses'], state['netg_losses']
 
-    # SAVE: data parallel model => add .module
+    # SAVE: data parallel model => unwrap (.module)
     # LOAD: create model and load checkpoints(not add .module) and wrap nn.DataParallel
     # this is for fitting prefix
 
@@ -225,12 +452,14 @@ class TACGAN():
         name_netG = "netg_checkpoints/netG_" + self.save_prefix + "_epoch_" + str(self.continue_epoch) + ".pth"
         self.netG.load_state_dict(torch.load(os.path.join(self.save_dir, name_netG)))
         self.netD.load_state_dict(torch.load(os.path.join(self.save_dir, name_netD)))
-        print("Checkpoints loaded successfuly")
+        self.log("Checkpoints loaded successfuly")
          
 
 def main(args):
     tac_gan = TACGAN(args)
     tac_gan.train()
+    if tac_gan.distributed:
+        dist.destroy_process_group()
 
 
 if __name__=='__main__':
@@ -246,6 +475,8 @@ if __name__=='__main__':
     parser.add_argument('--use-cuda', action='store_true')
     parser.add_argument('--continue-training', action='store_true')
     parser.add_argument('--continue-epoch', type=int, default=0)
+    parser.add_argument('--resume', action='store_true') # continue from the latest full checkpoint in <save-dir>/checkpoints
+    parser.add_argument('--keep-checkpoints', type=int, default=3) # full checkpoints kept, 0: all
     parser.add_argument('--netg-path', type=str, default='')
     parser.add_argument('--netd-path', type=str, default='')
     parser.add_argument('--image-size', type=int, default=128)
@@ -257,5 +488,17 @@ if __name__=='__main__':
     parser.add_argument('--save-prefix', type=str, default='')
     parser.add_argument('--save-after', type=int, default=5)
     parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--meta-mode', type=str, default='memory', choices=['memory', 'mmap', 'h5'])
+    parser.add_argument('--image-mode', type=str, default='jpeg', choices=['jpeg', 'shard'])
+    parser.add_argument('--image-dir', type=str, default=None)
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--distributed', action='store_true') # run under torchrun
+    parser.add_argument('--dist-backend', type=str, default=None, choices=['nccl', 'gloo']) # default: nccl on gpu, gloo on cpu
+    parser.add_argument('--sync-bn', action='store_true')
+    parser.add_argument('--fused-d', type=str, default='off', choices=['off', 'group', 'joint']) # one NetD forward for wrong/real/fake
+    parser.add_argument('--log-every', type=int, default=50) # steps per progress line / metrics record
+    parser.add_argument('--metrics-file', type=str, default=None) # .jsonl or .csv, default: <save-dir>/metrics.jsonl
+    parser.add_argument('--tensorboard-dir', type=str, default=None)
+    parser.add_argument('--metrics-sync', action='store_true') # exact per-phase cuda times, synchronizes the device at every phase (slower)
     args = parser.parse_args()
     main(args)